@@ -5,8 +5,42 @@ from urllib.parse import quote
 
 from dotenv import load_dotenv
 import os
-import threading
+import sys
+import time
+import logging
+import itertools
+from collections import Counter
+import json
 import re
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from broadcast import Broadcaster
+from consultations import ConsultationDesk, is_digest, parse_answer
+from db import Store
+from dispatcher import ChatDispatcher
+from metrics import Metrics
+from router import Router
+from posts import MEDIA_TYPES, UNSUPPORTED_TYPES, post_from_message, add_to_album, with_footer, post_text, describe, send_post
+from scheduler import Scheduler
+from subscribers import SubscriberTable, MAX_GROUPS, INACTIVE
+from transport import PooledTransport, AsyncTransport
+from webhook import WebhookApp
+
+logger = logging.getLogger(__name__)
+
+SCHEDULE_FORMAT = "%d.%m.%Y %H:%M"
+BROADCAST_FOOTER = "\n\nЖивые Проекты\n" \
+                   "[Instagram](https://www.instagram.com/lifeprojectsru) | " \
+                   "[Telegram](https://t.me/livingprojects)"
+SCHEDULE_TIMEZONE = ZoneInfo(os.environ.get("BOT_TIMEZONE", "Europe/Moscow"))
+# Причины, по которым получатель рассылки недоступен (broadcast.classify_failure)
+UNDELIVERABLE_REASONS = {
+    "blocked": "заблокировали бота",
+    "deactivated": "удалили аккаунт",
+    "not_found": "чат не найден",
+    "migrated": "сменили id чата",
+}
 
 
 class User:
@@ -14,7 +48,6 @@ class User:
         self.chat_id = chat_id
         self.groups = groups if groups else ["news"]
         self.contact = contact
-        self.consultation_requests = []  # Добавлено для хранения запросов
 
 
 class Admin(User):
@@ -22,7 +55,9 @@ class Admin(User):
         super().__init__(chat_id)
         self.password = password
         self.publish_mode = False
-        self.pending_message = None
+        self.pending_message = None  # черновик рассылки, см. posts.py
+        self.pending_message_group = None
+        self.pending_media_group = None  # media_group_id собираемого альбома
 
 class SuperAdmin(Admin):
     def __init__(self, chat_id):
@@ -30,32 +65,123 @@ class SuperAdmin(Admin):
 
 
 class BotManager:
-    def __init__(self, token, admin_password, superadmin_password, group_chat_id):
-        self.bot = telebot.TeleBot(token)
+    def __init__(self, token, admin_password, superadmin_password, group_chat_id, store=None, transport=None):
+        # Обработчики выполняются в потоках ChatDispatcher, пул telebot не нужен
+        self.bot = telebot.TeleBot(token, threaded=False)
+        self.dispatcher = ChatDispatcher(self.bot)
+        self.metrics = Metrics()
+        # Общий пул соединений к Bot API вместо сессии на каждый поток
+        self.transport = transport
+        if transport:
+            transport.install()
+            if isinstance(transport, AsyncTransport):
+                transport.metrics = self.metrics  # асинхронные вызовы идут мимо instrument_api
         self.admin_password = admin_password
         self.superadmin_password = superadmin_password
         self.admins = {}
         self.superadmins = {}
-        self.subscribers = {}
+        self.subscribers = SubscriberTable()  # chat_id -> битовая маска групп
+        self.news_mask = self.subscribers.intern("news")
         self.groups = {"news": "Новостная группа"}
+        self.keyboards = {}  # кэш сериализованных клавиатур, сбрасывается при изменении groups
         self.group_chat_id = group_chat_id  # Добавлено для группы
         self.publish_timeout = 15 * 60 # 15 minutes in seconds
-        self.timers = {}
+        self.scheduler = Scheduler()  # таймауты режима публикации и отложенные рассылки
+        self.scheduled_ids = itertools.count(1)  # id отложенных рассылок, если нет хранилища
+        self.store = store
+        self.broadcaster = Broadcaster(self.bot, metrics=self.metrics, store=store,
+                                       on_undeliverable=self.handle_undeliverable,
+                                       transport=transport if isinstance(transport, AsyncTransport) else None,
+                                       scheduler=self.scheduler)
+        self.audience_report_interval = 24 * 60 * 60
+        self.undeliverable_since_report = Counter()  # причина -> число с прошлого отчёта
+        self.last_audience_report = time.time()
+        # Запросы консультаций уходят в группу администраторов дайджестами
+        self.consultations = ConsultationDesk(self.bot, group_chat_id, store=store,
+                                              timezone=SCHEDULE_TIMEZONE, metrics=self.metrics)
 
         # Обработчики команд
-        self.bot.message_handler(commands=['start'])(self.start)
-        self.bot.message_handler(commands=['admin'])(self.admin_login)
-        self.bot.message_handler(commands=['superadmin'])(self.superadmin_login)
-        self.bot.message_handler(commands=['publish'])(self.enter_publish_mode)
-        self.bot.message_handler(commands=['stop'])(self.exit_publish_mode)
-        self.bot.message_handler(commands=['help'])(self.help_command)
-        self.bot.message_handler(commands=['create_group'])(self.create_group)
-        self.bot.message_handler(commands=['home'])(self.home)
-        self.bot.message_handler(commands=['consultation'])(self.request_consultation)
-        self.bot.message_handler(func=lambda message: True)(self.handle_message)
-        self.bot.callback_query_handler(func=lambda call: call.data.startswith("select_group_"))(self.handle_group_selection)
-        self.bot.callback_query_handler(func=lambda call: call.data.startswith("subscribe_"))(self.handle_subscription)
-        self.bot.callback_query_handler(func=lambda call: call.data in ["confirm_send", "edit_message", "cancel_message"])(self.handle_confirmation)
+        self.router = Router()
+        self.router.command('start', self.start)
+        self.router.command('admin', self.admin_login)
+        self.router.command('superadmin', self.superadmin_login)
+        self.router.command('publish', self.enter_publish_mode)
+        self.router.command('stop', self.exit_publish_mode)
+        self.router.command('help', self.help_command)
+        self.router.command('create_group', self.create_group)
+        self.router.command('home', self.home)
+        self.router.command('consultation', self.request_consultation)
+        self.router.command('reply', self.answer_consultation)
+        self.router.command('broadcasts', self.broadcasts_command)
+        self.router.fallback(self.handle_message)
+        self.router.callback_param('select_group', self.handle_group_selection, legacy_prefix="select_group_")
+        self.router.callback_param('subscribe', self.handle_subscription, legacy_prefix="subscribe_")
+        self.router.callback_param('cancel_broadcast', self.cancel_broadcast, param=int)
+        for action in ["confirm_send", "schedule_send", "edit_message", "cancel_message"]:
+            self.router.callback(action, self.handle_confirmation)
+        self.metrics.instrument_handlers(self.router)
+
+        # telebot проверяет по одному обработчику на тип апдейта, дальше решает таблица маршрутов
+        self.bot.message_handler(func=lambda message: True, content_types=["text", *MEDIA_TYPES, *UNSUPPORTED_TYPES])(self.router.route_message)
+        self.bot.callback_query_handler(func=lambda call: True)(self.router.route_callback)
+        self.metrics.instrument_api(self.bot)
+        self.register_gauges()
+
+    def startup(self):
+        """Restore saved state and resume pending work; only the serving process calls this."""
+        if self.store:
+            self.load_state()
+            self.load_scheduled()
+            self.consultations.load()
+            self.broadcaster.resume()
+            # Отсчёт до отчёта об аудитории не начинается заново при каждом перезапуске
+            saved = self.store.get_setting("audience_report_at")
+            if saved is None:
+                self.store.set_setting("audience_report_at", self.last_audience_report)
+            else:
+                self.last_audience_report = float(saved)
+        self.scheduler.call_at(self.last_audience_report + self.audience_report_interval, ("audience_report",),
+                               self.send_audience_report)
+
+    def register_gauges(self):
+        gauges = {
+            "dispatcher_queue_depth": lambda: sum(self.dispatcher.depths()),
+            "broadcast_queue_depth": self.broadcaster.queue.qsize,
+            "broadcasts_active": lambda: len(self.broadcaster.active),
+            "publish_sessions": lambda: sum(1 for admin in list(self.admins.values()) if admin.publish_mode),
+            "scheduled_timers": lambda: len(self.scheduler.entries),
+            "consultations_backlog": self.consultations.backlog,
+            "subscribers": lambda: len(self.subscribers),
+            "subscribers_inactive": self.subscribers.count_inactive,
+        }
+        if self.store:
+            gauges["store_queue_depth"] = self.store.queue.qsize
+        for name, read in gauges.items():
+            self.metrics.gauge(name, read)
+
+    def load_state(self):
+        """Preload groups, subscribers and admins from the store."""
+        groups, subscribers, admins, inactive = self.store.load()
+        if "news" not in groups:
+            self.store.save_group("news", self.groups["news"])
+        self.groups.update(groups)
+        self.keyboards.clear()
+        for group_id in self.groups:
+            self.subscribers.intern(group_id)
+        self.subscribers.load(
+            (chat_id, self.subscribers.mask_of(group_ids or ["news"]) | (INACTIVE if chat_id in inactive else 0))
+            for chat_id, group_ids in subscribers.items())
+        for chat_id, role in admins.items():
+            self.admins[chat_id] = Admin(chat_id, self.admin_password)
+            if role == "superadmin":
+                self.superadmins[chat_id] = SuperAdmin(chat_id)
+
+    def load_scheduled(self):
+        """Re-arm scheduled broadcasts that were pending before a restart."""
+        for row in self.store.load_scheduled():
+            post = json.loads(row.payload) if row.payload else {"type": "text", "text": row.text}
+            self.scheduler.call_at(row.send_at, ("broadcast", row.id), self.send_scheduled_broadcast,
+                                   row.id, row.admin_chat_id, row.group_id, post)
 
     def start(self, message):
         chat_id = message.chat.id
@@ -64,28 +190,144 @@ class BotManager:
         params = message.text.split()
         if len(params) > 1 and params[1] in self.groups:
             group = params[1]
-            self.subscribers[chat_id] = User(chat_id, [group, "news"])
+            self.set_subscriber(chat_id, [group, "news"])
             self.bot.send_message(chat_id, f'Вы были добавлены в группу "{self.groups[group]}" \n\n Привет! Я бот Живых Проектов 🤖 \n\n Рад видеть тебя на нашем курса "Как создать свое медиа". Мне всегда можно писать с вопросами, а еще я буду присылать напоминания про наши еженедельные вебинары с экспертами курса 🔥')
         else:
-            self.subscribers[chat_id] = User(chat_id, ["news"])
+            self.set_subscriber(chat_id, ["news"])
 
         # Показываем доступные группы
         self.show_home_menu(chat_id)
 
+    def set_subscriber(self, chat_id, groups, persist=True):
+        """Create or replace a subscriber with the given groups."""
+        groups = groups or ["news"]
+        self.subscribers.set(chat_id, self.subscribers.mask_of(groups))
+        if persist and self.store:
+            self.store.save_subscriber(chat_id, groups)
+
+    def subscribe(self, chat_id, group_id):
+        """Add a subscriber to a group. Returns False if already subscribed."""
+        mask = self.subscribers.intern(group_id)
+        existed = chat_id in self.subscribers
+        if not self.subscribers.add(chat_id, mask, default=self.news_mask):
+            return False
+        if self.store:
+            if existed:
+                self.store.add_membership(chat_id, group_id)
+            else:
+                self.store.save_subscriber(chat_id, self.subscribers.groups_of(self.news_mask | mask))
+        return True
+
+    def subscriber_groups(self, chat_id):
+        mask = self.subscribers.get(chat_id)
+        return self.subscribers.groups_of(mask) if mask is not None else []
+
+    def add_group(self, group_id, group_name):
+        self.subscribers.intern(group_id)  # ValueError, если биты масок закончились
+        self.groups[group_id] = group_name
+        self.keyboards.clear()
+        if self.store:
+            self.store.save_group(group_id, group_name)
+
+    def resolve_audience(self, group_id):
+        """Chat ids that receive a message for the group: its members plus 'news'."""
+        return self.subscribers.audience(self.subscribers.intern(group_id) | self.news_mask)
+
+    def handle_undeliverable(self, chat_id, reason, new_chat_id=None):
+        """Drop a dead recipient from future audiences or move it to its new chat id."""
+        if reason == "migrated":
+            mask = self.subscribers.remove(chat_id)
+            if mask is None:
+                return
+            self.subscribers.set(new_chat_id, mask)
+            if self.store:
+                self.store.migrate_subscriber(chat_id, new_chat_id, self.subscribers.groups_of(mask))
+        elif self.subscribers.deactivate(chat_id):
+            if self.store:
+                self.store.set_inactive(chat_id, reason)
+        else:
+            return
+        self.undeliverable_since_report[reason] += 1
+        self.metrics.inc("subscribers_undeliverable_total", reason=reason)
+
+    def send_audience_report(self):
+        """Periodic summary for admins: how much of the audience is still reachable."""
+        since, self.last_audience_report = self.last_audience_report, time.time()
+        self.scheduler.call_at(self.last_audience_report + self.audience_report_interval, ("audience_report",),
+                               self.send_audience_report)
+        recent, self.undeliverable_since_report = self.undeliverable_since_report, Counter()
+        if self.store:
+            self.store.set_setting("audience_report_at", self.last_audience_report)
+            self.store.flush()  # отметки о недоступности тоже пишутся через очередь
+            # Счётчик в памяти не переживает перезапуск, поэтому новых недоступных считаем по базе.
+            # Смену id чата база не отмечает - её берём из счётчика
+            migrated = recent["migrated"]
+            recent = Counter(self.store.inactive_counts(since=since))
+            if migrated:
+                recent["migrated"] = migrated
+        total = len(self.subscribers)
+        inactive = self.subscribers.count_inactive()
+
+        lines = [
+            "Состояние аудитории:",
+            f"Всего подписчиков: {total}",
+            f"Доступны: {total - inactive}",
+            f"Недоступны: {inactive}",
+        ]
+        if self.store:
+            lines += [f"  {UNDELIVERABLE_REASONS.get(reason, reason)}: {count}" for reason, count in self.store.inactive_counts().items()]
+        hours = round((self.last_audience_report - since) / 3600)
+        if recent:
+            lines.append(f"За последние {hours} ч:")
+            lines += [f"  {UNDELIVERABLE_REASONS.get(reason, reason)}: {count}" for reason, count in recent.items()]
+        else:
+            lines.append(f"За последние {hours} ч новых недоступных нет.")
+
+        for admin_chat_id in list(self.admins):
+            try:
+                self.bot.send_message(admin_chat_id, "\n".join(lines))
+            except Exception:
+                logger.exception("Failed to send audience report to %s", admin_chat_id)
+
     def home(self, message):
         chat_id = message.chat.id
         self.show_home_menu(chat_id)
     
     def show_home_menu(self, chat_id):
         # Главное меню с кнопками для подписки на рассылки
-        markup = types.InlineKeyboardMarkup()
+        self.bot.send_message(chat_id, "Добро пожаловать в главное меню! Выберите рассылку, на которую хотите подписаться:", reply_markup=self.keyboard("home"))
 
-        # Показываем только публичные группы (которые не заканчиваются на 'private')
-        for group_id, group_name in self.groups.items():
-            if not group_id.endswith("private"):
-                markup.add(types.InlineKeyboardButton(text=f"Подписаться на {group_name}", callback_data=f"subscribe_{group_id}"))
+    def keyboard(self, name):
+        """Return a pre-serialized keyboard, building it once per change of groups."""
+        markup = self.keyboards.get(name)
+        if markup is None:
+            markup = self.keyboards[name] = self.build_keyboard(name).to_json()
+        return markup
 
-        self.bot.send_message(chat_id, "Добро пожаловать в главное меню! Выберите рассылку, на которую хотите подписаться:", reply_markup=markup)
+    def build_keyboard(self, name):
+        markup = types.InlineKeyboardMarkup()
+        if name == "home":
+            # Показываем только публичные группы (которые не заканчиваются на 'private')
+            for group_id, group_name in self.groups.items():
+                if not group_id.endswith("private"):
+                    markup.add(types.InlineKeyboardButton(text=f"Подписаться на {group_name}", callback_data=Router.data("subscribe", group_id)))
+        elif name == "select_group":
+            # Кнопки для выбора группы
+            for group_id, group_name in self.groups.items():
+                markup.add(types.InlineKeyboardButton(text=group_name, callback_data=Router.data("select_group", group_id)))
+        elif name == "confirm":
+            # Кнопки для подтверждения
+            markup.add(
+                types.InlineKeyboardButton(text="Отправить", callback_data="confirm_send"),
+                types.InlineKeyboardButton(text="Запланировать", callback_data="schedule_send"),
+                types.InlineKeyboardButton(text="Изменить", callback_data="edit_message"),
+                types.InlineKeyboardButton(text="Отменить", callback_data="cancel_message")
+            )
+        return markup
+
+    def subscription_link(self, group_id):
+        # bot.user кэширует getMe, так что имя бота запрашивается один раз
+        return f"https://t.me/{self.bot.user.username}?start={quote(group_id)}"
 
     def admin_login(self, message):
         chat_id = message.chat.id
@@ -128,18 +370,15 @@ class BotManager:
         if chat_id in self.admins and self.admins[chat_id].publish_mode:
             self.admins[chat_id].publish_mode = False
             self.admins[chat_id].pending_message = None
-        if chat_id in self.timers:
-            self.timers[chat_id].cancel()
+            self.admins[chat_id].pending_message_group = None
+            self.admins[chat_id].pending_media_group = None
+        self.scheduler.cancel(("publish", chat_id))
 
     def reset_inactivity_timer(self, chat_id):
         """Reset the inactivity timer for the admin's publish mode."""
-        if chat_id in self.timers:
-            self.timers[chat_id].cancel()
-
-        # Start a new timer
-        timer = threading.Timer(self.publish_timeout, lambda: self.exit_publish_mode_due_to_inactivity(chat_id))
-        self.timers[chat_id] = timer
-        timer.start()
+        # Новый срок заменяет предыдущий с тем же ключом
+        self.scheduler.call_later(self.publish_timeout, ("publish", chat_id),
+                                  self.exit_publish_mode_due_to_inactivity, chat_id)
 
     def exit_publish_mode_due_to_inactivity(self, chat_id):
         """Exit publish mode after 15 minutes of inactivity."""
@@ -177,13 +416,15 @@ class BotManager:
             if group_id in self.groups:
                 self.bot.send_message(chat_id, "Группа с таким ID уже существует. Попробуйте снова:")
                 self.bot.register_next_step_handler(message, self.get_group_id, group_name)
+            elif len(self.groups) >= MAX_GROUPS:
+                self.bot.send_message(chat_id, f"Нельзя создать больше {MAX_GROUPS} групп.")
             else:
                 # Сохраняем новую группу
-                self.groups[group_id] = group_name
+                self.add_group(group_id, group_name)
                 self.bot.send_message(chat_id, f"Группа '{group_name}' с ID '{group_id}' успешно создана.")
 
                 # Генерируем ссылку на подписку
-                link = f"https://t.me/{self.bot.get_me().username}?start={quote(group_id)}"
+                link = self.subscription_link(group_id)
                 self.bot.send_message(chat_id, f"Ссылка для подписки на группу '{group_name}': {link}")
 
                 # Проверяем, приватная ли группа (ID заканчивается на 'private')
@@ -198,21 +439,19 @@ class BotManager:
 
         # Добавляем новую группу
         group_id = group_name.lower().replace(" ", "_")
-        self.groups[group_id] = group_name
+        self.add_group(group_id, group_name)
         self.bot.send_message(chat_id, f"Группа '{group_name}' успешно создана.")
 
         # Генерируем ссылку на подписку
-        link = f"https://t.me/{self.bot.get_me().username}?start={quote(group_id)}"
+        link = self.subscription_link(group_id)
         self.bot.send_message(chat_id, f"Ссылка для подписки на группу '{group_name}': {link}")
 
 
-    def handle_subscription(self, call):
+    def handle_subscription(self, call, subscription_type):
         chat_id = call.message.chat.id
-        subscription_type = call.data.split("subscribe_")[1]
-        
+
         if subscription_type in self.groups.keys():
-            if subscription_type not in self.subscribers[chat_id].groups:
-                self.subscribers[chat_id].groups.append(subscription_type)
+            if self.subscribe(chat_id, subscription_type):
                 self.bot.send_message(chat_id, f"Вы подписались на рассылку {self.groups[subscription_type]}.")
             else:
                 self.bot.send_message(chat_id, f"Вы уже подписаны на рассылку {self.groups[subscription_type]}.")
@@ -221,22 +460,41 @@ class BotManager:
         chat_id = message.chat.id
         text = message.text
 
-        if chat_id in self.admins and self.admins[chat_id].publish_mode:
-            # Сохраняем сообщение, чтобы потом отправить его в выбранную группу
-            self.admins[chat_id].pending_message = text
-
-            # Создаем кнопки для выбора группы
-            markup = types.InlineKeyboardMarkup()
-            for group_id, group_name in self.groups.items():
-                markup.add(types.InlineKeyboardButton(text=group_name, callback_data=f"select_group_{group_id}"))
+        if self.is_admin_group(chat_id):
+            # Ответом на запрос считается только reply на дайджест бота; остальное - переписка
+            # администраторов и ответы на служебные сообщения, их молча пропускаем
+            replied = message.reply_to_message
+            if (text and replied and replied.from_user and replied.from_user.id == self.bot.user.id
+                    and is_digest(replied.text)):
+                self.answer_consultation(message)
+        elif chat_id in self.admins and self.admins[chat_id].publish_mode:
+            admin = self.admins[chat_id]
+            # Остальные части альбома приходят отдельными сообщениями с тем же media_group_id
+            if message.media_group_id and message.media_group_id == admin.pending_media_group:
+                add_to_album(admin.pending_message, message)
+                return
+
+            post = post_from_message(message)
+            if post is None:
+                self.bot.send_message(chat_id, "Такой тип сообщения нельзя разослать. Отправьте текст, фото, видео, документ, аудио или голосовое сообщение.")
+                return
 
-            self.bot.send_message(chat_id, "Выберите группу для отправки сообщения:", reply_markup=markup)
+            # Сохраняем сообщение, чтобы потом отправить его в выбранную группу
+            admin.pending_message = post
+            admin.pending_message_group = None  # группу для нового черновика выбирают заново
+            admin.pending_media_group = message.media_group_id
+            self.bot.send_message(chat_id, "Выберите группу для отправки сообщения:", reply_markup=self.keyboard("select_group"))
 
-        elif text == self.admin_password:
+        # У медиа нет text: паролем оно быть не может, даже если пароль не задан
+        elif text and text == self.admin_password:
             self.admins[chat_id] = Admin(chat_id, self.admin_password)
+            if self.store:
+                self.store.save_admin(chat_id, "admin")
             self.bot.send_message(chat_id, "Пароль администратора принят. Вы вошли в режим администратора. Используйте команду /publish для публикации.")
-        elif text == self.superadmin_password and chat_id in self.admins:
+        elif text and text == self.superadmin_password and chat_id in self.admins:
             self.superadmins[chat_id] = SuperAdmin(chat_id)
+            if self.store:
+                self.store.save_admin(chat_id, "superadmin")
             self.bot.send_message(chat_id, "Пароль супер-администратора принят. Вы теперь супер-администратор.")
             self.notify_superadmins(f"Пользователь {chat_id} стал супер-администратором.")
         elif chat_id in self.admins:
@@ -249,25 +507,26 @@ class BotManager:
             self.bot.send_message(superadmin_id, message_text)
 
 
-    def handle_group_selection(self, call):
+    def handle_group_selection(self, call, group_id):
         chat_id = call.message.chat.id
-        group_id = call.data.split("select_group_")[1]
 
         if chat_id in self.admins and self.admins[chat_id].publish_mode:
             # Сохраняем выбранную группу для отправки
             self.admins[chat_id].pending_message_group = group_id
             group_name = self.groups[group_id]
 
-            # Создание кнопок для подтверждения
-            markup = types.InlineKeyboardMarkup()
-            markup.add(
-                types.InlineKeyboardButton(text="Отправить", callback_data="confirm_send"),
-                types.InlineKeyboardButton(text="Изменить", callback_data="edit_message"),
-                types.InlineKeyboardButton(text="Отменить", callback_data="cancel_message")
-            )
 
             # Предварительный просмотр сообщения
-            self.bot.send_message(chat_id, f"Хотите отправить это сообщение в группу '{group_name}'?\n\n{self.admins[chat_id].pending_message}", reply_markup=markup)
+            post = self.admins[chat_id].pending_message
+            if post is None:
+                # Кнопка от старого сообщения, а после /publish ещё ничего не прислали
+                self.bot.send_message(chat_id, "Сначала отправьте сообщение, которое нужно разослать.")
+                return
+            if post["type"] == "text":
+                self.bot.send_message(chat_id, f"Хотите отправить это сообщение в группу '{group_name}'?\n\n{post['text']}", reply_markup=self.keyboard("confirm"))
+            else:
+                send_post(self.bot, chat_id, post)
+                self.bot.send_message(chat_id, f"Хотите отправить это сообщение ({describe(post)}) в группу '{group_name}'?", reply_markup=self.keyboard("confirm"))
 
     
 
@@ -276,24 +535,28 @@ class BotManager:
         action = call.data
         
         if chat_id in self.admins and self.admins[chat_id].publish_mode:
-            if action == "confirm_send":
-                message_text = self.admins[chat_id].pending_message
-
-                # Добавляем ссылки в конец сообщения
-                message_text += "\n\nЖивые Проекты\n" \
-                                "[Instagram](https://www.instagram.com/lifeprojectsru) | " \
-                                "[Telegram](https://t.me/livingprojects)"
-                
-                group_id = self.admins[chat_id].pending_message_group
-
-                # Отправляем сообщение подписчикам выбранной группы
-                for subscriber in self.subscribers.values():
-                    if group_id in subscriber.groups or 'news' in subscriber.groups:
-                        self.bot.send_message(subscriber.chat_id, message_text, parse_mode="Markdown")
-
-                self.bot.send_message(chat_id, "Сообщение отправлено подписчикам.")
+            admin = self.admins[chat_id]
+            if action in ("confirm_send", "schedule_send") and admin.pending_message is None:
+                # Кнопка от черновика, который уже отправлен или отменён
+                self.bot.send_message(chat_id, "Сначала отправьте сообщение, которое нужно разослать.")
+            elif action in ("confirm_send", "schedule_send") and admin.pending_message_group is None:
+                # Кнопка от прошлого черновика: для нового группа ещё не выбрана
+                self.bot.send_message(chat_id, "Выберите группу для отправки сообщения:", reply_markup=self.keyboard("select_group"))
+            elif action == "confirm_send":
+                post = self.compose_broadcast(admin.pending_message)
+                group_id = admin.pending_message_group
+
+                # Отправляем сообщение подписчикам выбранной группы в фоне,
+                # прогресс и итог придут в этот чат
+                recipients = self.resolve_audience(group_id)
+                self.broadcaster.broadcast(chat_id, recipients, post, parse_mode="Markdown")
+
                 self.disable_publish_mode(chat_id)
                 self.admins[chat_id].pending_message = None
+            elif action == "schedule_send":
+                self.bot.send_message(chat_id, f"Введите дату и время отправки в формате ДД.ММ.ГГГГ ЧЧ:ММ (время {SCHEDULE_TIMEZONE.key}):")
+                self.bot.register_next_step_handler(call.message, self.get_schedule_time)
+                self.reset_inactivity_timer(chat_id)
             elif action == "edit_message":
                 self.bot.send_message(chat_id, "Пожалуйста, введите новое сообщение.")
                 self.reset_inactivity_timer(chat_id)  # Reset the timer on interaction
@@ -301,6 +564,83 @@ class BotManager:
                 self.disable_publish_mode(chat_id)
                 self.bot.send_message(chat_id, "Сообщение отменено.")
 
+    def compose_broadcast(self, post):
+        # Добавляем ссылки в конец сообщения (или подписи к медиа)
+        return with_footer(post, BROADCAST_FOOTER)
+
+    def broadcasts_command(self, message):
+        """Progress of running broadcasts with a cancel button for each."""
+        chat_id = message.chat.id
+        if chat_id not in self.admins:
+            self.bot.send_message(chat_id, "Вы не авторизованы для выполнения этого действия.")
+            return
+
+        jobs = sorted(self.broadcaster.active.values(), key=lambda job: job.id)
+        if not jobs:
+            self.bot.send_message(chat_id, "Сейчас нет активных рассылок.")
+            return
+
+        lines = ["Активные рассылки:"]
+        markup = types.InlineKeyboardMarkup()
+        for job in jobs:
+            lines.append(f"#{job.id}: отправлено {job.processed} из {job.total}, не доставлено {job.failed}")
+            markup.add(types.InlineKeyboardButton(f"Отменить #{job.id}", callback_data=Router.data("cancel_broadcast", job.id)))
+        self.bot.send_message(chat_id, "\n".join(lines), reply_markup=markup)
+
+    def cancel_broadcast(self, call, job_id):
+        chat_id = call.message.chat.id
+        if chat_id not in self.admins:
+            self.bot.send_message(chat_id, "Вы не авторизованы для выполнения этого действия.")
+            return
+
+        job = self.broadcaster.active.get(job_id)
+        if job is None or not self.broadcaster.cancel(job_id):
+            self.bot.send_message(chat_id, f"Рассылка #{job_id} уже завершена.")
+        elif job.admin_chat_id != chat_id:
+            # Итог с числом доставленных получит администратор, запустивший рассылку
+            self.bot.send_message(chat_id, f"Рассылка #{job_id} отменена.")
+
+    def get_schedule_time(self, message):
+        chat_id = message.chat.id
+        if chat_id not in self.admins or not self.admins[chat_id].publish_mode:
+            return
+
+        try:
+            send_at = datetime.strptime((message.text or "").strip(), SCHEDULE_FORMAT).replace(tzinfo=SCHEDULE_TIMEZONE)
+        except ValueError:
+            self.bot.send_message(chat_id, "Не удалось разобрать дату. Введите её в формате ДД.ММ.ГГГГ ЧЧ:ММ:")
+            self.bot.register_next_step_handler(message, self.get_schedule_time)
+            return
+        if send_at.timestamp() <= datetime.now().timestamp():
+            self.bot.send_message(chat_id, "Это время уже прошло. Введите дату и время в будущем:")
+            self.bot.register_next_step_handler(message, self.get_schedule_time)
+            return
+
+        admin = self.admins[chat_id]
+        if admin.pending_message is None or admin.pending_message_group is None:
+            # Пока вводили время, черновик заменили или отменили
+            self.bot.send_message(chat_id, "Сначала отправьте сообщение, которое нужно разослать.")
+            return
+        self.schedule_broadcast(chat_id, admin.pending_message_group, self.compose_broadcast(admin.pending_message), send_at.timestamp())
+        self.bot.send_message(chat_id, f"Сообщение будет отправлено {send_at.strftime(SCHEDULE_FORMAT)}.")
+        self.disable_publish_mode(chat_id)
+
+    def schedule_broadcast(self, admin_chat_id, group_id, post, send_at):
+        """Persist a broadcast and send it at unix time `send_at`."""
+        if self.store:
+            scheduled_id = self.store.add_scheduled(admin_chat_id, group_id, post_text(post), json.dumps(post), send_at)
+        else:
+            scheduled_id = next(self.scheduled_ids)
+        self.scheduler.call_at(send_at, ("broadcast", scheduled_id), self.send_scheduled_broadcast,
+                               scheduled_id, admin_chat_id, group_id, post)
+        return scheduled_id
+
+    def send_scheduled_broadcast(self, scheduled_id, admin_chat_id, group_id, post):
+        # Аудиторию определяем в момент отправки, а не в момент планирования
+        self.broadcaster.broadcast(admin_chat_id, self.resolve_audience(group_id), post, parse_mode="Markdown")
+        if self.store:
+            self.store.set_scheduled_status(scheduled_id, "sent")
+
     def request_consultation(self, message):
         chat_id = message.chat.id
 
@@ -310,37 +650,48 @@ class BotManager:
         # Регистрация следующего шага для получения описания запроса
         self.bot.register_next_step_handler(message, self.save_consultation_request)
 
-    def save_consultation_request(self, message, group_name=None):
+    def save_consultation_request(self, message):
         chat_id = message.chat.id
-        description = message.text
+        description = message.text or message.caption
+
+        if not description:
+            self.bot.send_message(chat_id, "Пожалуйста, опишите ваш запрос текстом.")
+            self.bot.register_next_step_handler(message, self.save_consultation_request)
+            return
 
-        # Сохраняем описание запроса у пользователя
         if chat_id not in self.subscribers:
-            self.subscribers[chat_id] = User(chat_id)
+            self.set_subscriber(chat_id, None)
 
-        # Сохраняем запрос консультации
-        if not hasattr(self.subscribers[chat_id], 'consultation_requests'):
-            self.subscribers[chat_id].consultation_requests = []
+        # Запрос сохраняется сразу, а в группу администраторов уходит с ближайшим дайджестом
+        ticket = self.consultations.submit(chat_id, description, self.subscriber_groups(chat_id), message.date)
+        self.bot.send_message(chat_id, f"Ваш запрос на консультацию №{ticket.id} принят. Ответ придёт в этом боте!")
 
-        self.subscribers[chat_id].consultation_requests.append({
-            'description': description,
-            'timestamp': message.date,
-            'group_names': [self.groups[group_name]] if group_name else []
-        })
+    def is_admin_group(self, chat_id):
+        # GROUP_CHAT_ID приходит из окружения строкой
+        return self.group_chat_id is not None and str(chat_id) == str(self.group_chat_id)
 
-        # Формируем сообщение для администраторов
-        admin_message = (
-            f"Пользователь {chat_id} запросил консультацию.\n"
-            f"Описание запроса: {description}\n"
-            f"Время запроса: {message.date}\n"
-            f"Группы: {', '.join(self.subscribers[chat_id].groups)}\n"
-            f"Чтобы ответить пользователю, используйте функцию 'Reply' в этой группе."
-        )
+    def answer_consultation(self, message):
+        """Send an answer from the admin group to the author of a ticket.
 
-        # Отправляем сообщение в группу, где присутствуют администраторы
-        self.bot.send_message(self.group_chat_id, admin_message)
+        Either `/reply 12 текст` or a reply to a digest, see consultations.parse_answer.
+        """
+        chat_id = message.chat.id
+        if not self.is_admin_group(chat_id):
+            self.bot.send_message(chat_id, "Отвечать на запросы можно только из группы администраторов.")
+            return
 
-        self.bot.send_message(chat_id, "Ваш запрос на консультацию отправлен. Ожидайте ответа.")
+        text = message.text or ""
+        if text.startswith("/"):
+            parsed = parse_answer(text.partition(" ")[2])
+        else:
+            parsed = parse_answer(text, message.reply_to_message.text)
+        if parsed is None:
+            self.bot.reply_to(message, "Укажите номер запроса: #12 текст ответа.")
+            return
+
+        ticket_id, answer = parsed
+        if self.consultations.answer(ticket_id, answer) is None:
+            self.bot.reply_to(message, f"Запрос №{ticket_id} не найден.")
 
     def help_command(self, message):
         chat_id = message.chat.id
@@ -353,6 +704,8 @@ class BotManager:
                 "/publish - Войти в режим публикации\n"
                 "/stop - Выйти из режима публикации\n"
                 "/create_group - Создать новую группу\n"
+                "/broadcasts - Активные рассылки: прогресс и отмена\n"
+                "/reply - Ответить на запрос консультации (в группе администраторов)\n"
                 "/help - Показать это сообщение\n"
             )
         elif chat_id in self.admins:
@@ -362,6 +715,8 @@ class BotManager:
                 "/publish - Войти в режим публикации\n"
                 "/stop - Выйти из режима публикации\n"
                 "/create_group - Создать новую группу\n"
+                "/broadcasts - Активные рассылки: прогресс и отмена\n"
+                "/reply - Ответить на запрос консультации (в группе администраторов)\n"
                 "/help - Показать это сообщение\n"
 
                 "Команды для всех пользователей:\n"
@@ -381,16 +736,67 @@ class BotManager:
 
         self.bot.send_message(chat_id, help_text)
     def run(self):
-        self.bot.polling()
+        self.startup()
+        # getUpdates не работает, пока установлен вебхук
+        self.bot.remove_webhook()
+        self.bot.user  # имя бота для ссылок запрашиваем один раз при запуске
+        self.poll()
+
+    def poll(self, timeout=30):
+        """Long-poll getUpdates and feed the chat lanes; a full lane pauses polling."""
+        offset = None
+        while True:
+            try:
+                updates = self.bot.get_updates(offset=offset, long_polling_timeout=timeout)
+            except Exception:
+                logger.exception("getUpdates failed")
+                time.sleep(3)
+                continue
+            for update in updates:
+                self.dispatcher.submit(update)
+                offset = update.update_id + 1
 
-# Initialize BotManager at the module level
 load_dotenv()
 TOKEN = os.environ.get("TELEGRAM_API_KEY")
 ADMIN_PASSWORD = os.environ.get("ADMIN_PASS")
 SUPERADMIN_PASSWORD = os.environ.get("SUPER_ADMIN_PASS")
 GROUP_CHAT_ID = os.environ.get("GROUP_CHAT_ID")
-app = BotManager(TOKEN, ADMIN_PASSWORD, SUPERADMIN_PASSWORD, GROUP_CHAT_ID)
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    raise RuntimeError("WEBHOOK_SECRET must be set together with WEBHOOK_URL")
+METRICS_PORT = os.environ.get("METRICS_PORT")
+HTTP_TRANSPORT = os.environ.get("HTTP_TRANSPORT", "pooled")  # default (как в telebot) | pooled | async
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 100 if HTTP_TRANSPORT == "async" else 32))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 30))
+
+
+def build_manager():
+    if HTTP_TRANSPORT == "async":
+        transport = AsyncTransport(TOKEN, HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    elif HTTP_TRANSPORT == "pooled":
+        transport = PooledTransport(HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    else:
+        transport = None
+    return BotManager(TOKEN, ADMIN_PASSWORD, SUPERADMIN_PASSWORD, GROUP_CHAT_ID, store=Store(), transport=transport)
+
+
+def create_app():
+    """WSGI application for `gunicorn 'app:create_app()'`."""
+    bot_manager = build_manager()
+    bot_manager.startup()
+    return WebhookApp(bot_manager, secret_token=WEBHOOK_SECRET)
 
-if __name__ == '__main__':
-    app.run()
 
+if __name__ == '__main__':
+    if sys.argv[1:] == ['set_webhook']:
+        # Запускается в release-фазе: с WEBHOOK_URL включает вебхук, без него - снимает.
+        # BotManager здесь не создаём: он восстановил бы состояние и продолжил бы рассылки
+        telebot.TeleBot(TOKEN).set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    else:
+        bot_manager = build_manager()
+        if METRICS_PORT:
+            # В режиме вебхука метрики отдаёт WebhookApp на /metrics
+            bot_manager.metrics.serve(int(METRICS_PORT))
+        bot_manager.run()
@@ -0,0 +1,278 @@
+"""Offline throughput benchmarks for BotManager.
+
+Runs the bot against a local fake Telegram Bot API and prints updates/s,
+broadcast msgs/s, handler latency percentiles and memory per 100k
+subscribers. Usage (from the repository root):
+
+    python -m bench
+    python -m bench --scenario broadcast --subscribers 20000 --latency 0.02 --blocked-share 0.05
+    python -m bench --scenario broadcast --latency 0.05 --transport async --pool-size 200
+"""
+import argparse
+import gc
+import itertools
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+# app.py и db.py читают окружение при импорте, поэтому готовим его заранее
+DATA_DIR = tempfile.mkdtemp(prefix="bot-bench-")
+os.environ["TELEGRAM_API_KEY"] = "1:bench"
+os.environ["BOT_SQLITE_URL"] = f"sqlite:///{os.path.join(DATA_DIR, 'bench.db')}"
+os.environ["ADMIN_PASS"] = "bench-admin"
+os.environ["SUPER_ADMIN_PASS"] = "bench-superadmin"
+os.environ["HTTP_TRANSPORT"] = "default"  # транспорт каждого BotManager задаёт --transport
+
+from sqlalchemy import create_engine, event  # noqa: E402
+from telebot import apihelper, types  # noqa: E402
+
+from app import BotManager  # noqa: E402
+from broadcast import TokenBucket  # noqa: E402
+from db import Base, Store, set_sqlite_pragma  # noqa: E402
+from transport import PooledTransport, AsyncTransport  # noqa: E402
+from bench.fake_api import FakeTelegramAPI  # noqa: E402
+
+ADMIN_CHAT_ID = 1
+GROUP_CHAT_ID = -1001
+bot_ids = itertools.count(1000)
+
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Нет /proc (macOS): берём пиковое значение, оно в байтах
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def user(chat_id):
+    return {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+
+
+def message_update(chat_id, text):
+    message = {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+               "from": user(chat_id), "text": text}
+    return {"message": message}
+
+
+def callback_update(chat_id, data):
+    message = {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "text": "menu"}
+    return {"callback_query": {"id": str(chat_id), "from": user(chat_id), "chat_instance": "bench",
+                               "data": data, "message": message}}
+
+
+class Harness:
+    def __init__(self, api, args):
+        self.api = api
+        self.args = args
+
+    def store(self, bot_id):
+        """A Store on its own SQLite file, so startup() doesn't resume another scenario's broadcast."""
+        engine = create_engine(f"sqlite:///{os.path.join(DATA_DIR, f'bench-{bot_id}.db')}")
+        event.listen(engine, "connect", set_sqlite_pragma)
+        Base.metadata.create_all(engine)
+        return Store(engine, flush_interval=0.05)
+
+    def manager(self, poll=True):
+        """A fresh BotManager with its own token, so its updates don't mix with others."""
+        bot_id = next(bot_ids)
+        token = f"{bot_id}:bench"
+        store = self.store(bot_id) if self.args.with_store else None
+        if self.args.transport == "async":
+            transport = AsyncTransport(token, self.args.pool_size)
+        elif self.args.transport == "pooled":
+            transport = PooledTransport(self.args.pool_size)
+        else:
+            apihelper.CUSTOM_REQUEST_SENDER = None  # сессия requests на поток, как в telebot по умолчанию
+            transport = None
+        manager = BotManager(token, os.environ["ADMIN_PASS"], os.environ["SUPER_ADMIN_PASS"], GROUP_CHAT_ID,
+                             store=store, transport=transport)
+        manager.broadcaster.bucket = TokenBucket(self.args.broadcast_rate)
+        manager.startup()
+
+        # Время обработки каждого апдейта и число обработанных
+        manager.latencies = []
+        process = manager.bot.process_new_updates
+
+        def timed(updates):
+            started = time.perf_counter()
+            try:
+                process(updates)
+            finally:
+                manager.latencies.append(time.perf_counter() - started)
+
+        manager.bot.process_new_updates = timed
+        if poll:
+            threading.Thread(target=manager.poll, kwargs={"timeout": 1}, daemon=True).start()
+        return token, manager
+
+    def wait_handled(self, manager, count, timeout=600):
+        deadline = time.monotonic() + timeout
+        while len(manager.latencies) < count:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"only {len(manager.latencies)} of {count} updates handled")
+            time.sleep(0.005)
+
+    def start_flood(self):
+        token, manager = self.manager()
+        users = self.args.users
+        started = time.perf_counter()
+        for chat_id in range(10_000, 10_000 + users):
+            self.api.push_update(token, message_update(chat_id, "/start"))
+        self.wait_handled(manager, users)
+        elapsed = time.perf_counter() - started
+        return {
+            "updates": users,
+            "updates_per_s": users / elapsed,
+            "handler_p50_ms": percentile(manager.latencies, 0.5) * 1000,
+            "handler_p99_ms": percentile(manager.latencies, 0.99) * 1000,
+        }
+
+    def broadcast(self):
+        token, manager = self.manager()
+        subscribers = range(100_000, 100_000 + self.args.subscribers)
+        for chat_id in subscribers:
+            manager.set_subscriber(chat_id, ["news"], persist=False)
+        blocked_every = int(1 / self.args.blocked_share) if self.args.blocked_share else 0
+        if blocked_every:
+            self.api.blocked.update(subscribers[::blocked_every])
+
+        for text in (os.environ["ADMIN_PASS"], "/publish", "Бенчмарк рассылки"):
+            self.api.push_update(token, message_update(ADMIN_CHAT_ID, text))
+        self.api.push_update(token, callback_update(ADMIN_CHAT_ID, "select_group:news"))
+        self.wait_handled(manager, 4)
+        started = time.perf_counter()
+        self.api.push_update(token, callback_update(ADMIN_CHAT_ID, "confirm_send"))
+
+        finished = self.api.wait_for(
+            lambda api: any("завершена за" in text for text in api.sent[ADMIN_CHAT_ID]),
+            timeout=3600)
+        elapsed = time.perf_counter() - started
+        self.api.sent[ADMIN_CHAT_ID].clear()
+        return {
+            "recipients": len(subscribers),
+            "finished": finished,
+            "broadcast_msgs_per_s": len(subscribers) / elapsed,
+            "seconds": elapsed,
+            "blocked": len(subscribers[::blocked_every]) if blocked_every else 0,
+            # Заблокировавшие бота исключаются из следующих рассылок
+            "audience_after": len(manager.resolve_audience("news")),
+        }
+
+    def consultations(self):
+        token, manager = self.manager()
+        count = self.args.consultations
+        before = len(self.api.sent[GROUP_CHAT_ID])
+        started = time.perf_counter()
+        for chat_id in range(200_000, 200_000 + count):
+            self.api.push_update(token, message_update(chat_id, "/consultation"))
+            self.api.push_update(token, message_update(chat_id, "Нужна консультация по запуску медиа"))
+        self.wait_handled(manager, count * 2)
+        elapsed = time.perf_counter() - started
+        return {
+            "requests": count,
+            "requests_per_s": count / elapsed,
+            "admin_group_messages": len(self.api.sent[GROUP_CHAT_ID]) - before,
+            # Остальные тикеты уйдут следующими дайджестами, по лимиту ~20 сообщений в минуту
+            "digest_backlog": manager.consultations.backlog(),
+            "handler_p50_ms": percentile(manager.latencies, 0.5) * 1000,
+            "handler_p99_ms": percentile(manager.latencies, 0.99) * 1000,
+        }
+
+    def dispatch(self, rounds=20_000):
+        """Router overhead only: picking the handler for an update, without running it."""
+        _, manager = self.manager(poll=False)
+        router = manager.router
+        messages = [types.Message.de_json(message_update(42, text)["message"])
+                    for text in ("/start", "/start@bench_bot news", "/help", "/consultation", "просто текст")]
+        calls = [types.CallbackQuery.de_json(callback_update(42, data)["callback_query"])
+                 for data in ("subscribe:news", "select_group:news", "confirm_send", "subscribe_news")]
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for message in messages:
+                router.resolve_message(message)
+            for call in calls:
+                router.resolve_callback(call)
+        elapsed = time.perf_counter() - started
+        return {
+            "routes": len(router.commands) + len(router.callbacks) + len(router.param_callbacks),
+            "dispatch_us_per_update": elapsed / (rounds * (len(messages) + len(calls))) * 1e6,
+        }
+
+    def memory(self):
+        _, manager = self.manager(poll=False)
+        count = self.args.memory_subscribers
+        gc.collect()
+        before = rss_bytes()
+        for chat_id in range(1_000_000, 1_000_000 + count):
+            manager.set_subscriber(chat_id, ["news"], persist=False)
+        gc.collect()
+        grown = rss_bytes() - before
+        return {
+            "subscribers": count,
+            "rss_mb_per_100k": grown / 1024 / 1024 * 100_000 / count,
+        }
+
+
+SCENARIOS = ["start_flood", "broadcast", "consultations", "dispatch", "memory"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", choices=SCENARIOS, action="append", help="run only these scenarios")
+    parser.add_argument("--users", type=int, default=2000, help="/start updates in the flood")
+    parser.add_argument("--subscribers", type=int, default=5000, help="broadcast audience size")
+    parser.add_argument("--consultations", type=int, default=500, help="consultation requests in the burst")
+    parser.add_argument("--memory-subscribers", type=int, default=100_000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every API call")
+    parser.add_argument("--rate-limit-share", type=float, default=0.0, help="share of sendMessage calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--blocked-share", type=float, default=0.0, help="share of subscribers that answer 403")
+    parser.add_argument("--broadcast-rate", type=float, default=1000, help="broadcaster token bucket, msg/s")
+    parser.add_argument("--transport", choices=["default", "pooled", "async"], default="default",
+                        help="HTTP client for Bot API calls, see transport.py")
+    parser.add_argument("--pool-size", type=int, default=32, help="connections in the pooled/async transport")
+    parser.add_argument("--with-store", action="store_true", help="persist through the SQLite store")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="show handler errors (e.g. unhandled 429)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.ERROR if args.verbose else logging.CRITICAL)
+
+    api = FakeTelegramAPI(latency=args.latency, rate_limit_share=args.rate_limit_share,
+                          retry_after=args.retry_after).start()
+    apihelper.API_URL = api.api_url
+    harness = Harness(api, args)
+
+    results = {}
+    for name in args.scenario or SCENARIOS:
+        results[name] = getattr(harness, name)()
+        if not args.json:
+            print(name)
+            for key, value in results[name].items():
+                print(f"  {key:24} {value:.2f}" if isinstance(value, float) else f"  {key:24} {value}")
+    results["api_calls"] = {f"{method} {status}": count for (method, status), count in sorted(api.calls.items(), key=str)}
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+    else:
+        print("api_calls")
+        for key, value in results["api_calls"].items():
+            print(f"  {key:24} {value}")
+    api.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+import itertools
+import json
+import random
+import re
+import socket
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+
+class FakeTelegramAPI:
+    """Local stand-in for the Telegram Bot API.
+
+    Implements just enough of getUpdates, sendMessage, answerCallbackQuery
+    and friends to drive BotManager offline. Every method can be slowed
+    down with `latency`, sendMessage can answer 429 with probability
+    `rate_limit_share`, and chats in `blocked` get 403.
+    """
+
+    def __init__(self, latency=0.0, rate_limit_share=0.0, retry_after=1, blocked=()):
+        self.latency = latency
+        self.rate_limit_share = rate_limit_share
+        self.retry_after = retry_after
+        self.blocked = set(blocked)
+        self.updates = defaultdict(list)  # token -> ожидающие апдейты
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.sent = defaultdict(list)  # chat_id -> тексты отправленных сообщений
+        self.calls = Counter()  # (method, status) -> количество
+        self.condition = threading.Condition()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def api_url(self):
+        """Value for telebot.apihelper.API_URL."""
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/bot{{0}}/{{1}}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-telegram", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def push_update(self, token, update):
+        """Queue an update (without update_id) for the bot with `token`."""
+        with self.condition:
+            update = dict(update, update_id=next(self.update_ids))
+            self.updates[token].append(update)
+            self.condition.notify_all()
+        return update["update_id"]
+
+    def wait_for(self, predicate, timeout=60):
+        """Block until `predicate(api)` is true; returns False on timeout."""
+        with self.condition:
+            return self.condition.wait_for(lambda: predicate(self), timeout)
+
+    def count(self, method, status=200):
+        return self.calls[(method, status)]
+
+    # Ответы методов Bot API
+
+    def call(self, token, method, params):
+        if self.latency and method != "getUpdates":
+            time.sleep(self.latency)
+        handler = getattr(self, f"api_{method}", None)
+        if handler is None:
+            return 200, {"ok": True, "result": True}
+        return handler(token, params)
+
+    def api_getMe(self, token, params):
+        bot_id = int(token.split(":")[0])
+        return 200, {"ok": True, "result": {"id": bot_id, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}}
+
+    def api_getUpdates(self, token, params):
+        offset = int(params.get("offset", 0))
+        timeout = float(params.get("timeout", 0))
+        with self.condition:
+            pending = self.updates[token]
+            # Telegram подтверждает апдейты, когда клиент просит offset больше их id
+            pending[:] = [update for update in pending if update["update_id"] >= offset]
+            if not pending and timeout:
+                self.condition.wait_for(lambda: self.updates[token], timeout)
+            result = pending[:100]
+        return 200, {"ok": True, "result": result}
+
+    def api_sendMessage(self, token, params):
+        chat_id = int(params["chat_id"])
+        if chat_id in self.blocked:
+            return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+        if self.rate_limit_share and random.random() < self.rate_limit_share:
+            return 429, {"ok": False, "error_code": 429,
+                         "description": f"Too Many Requests: retry after {self.retry_after}",
+                         "parameters": {"retry_after": self.retry_after}}
+        with self.condition:
+            self.sent[chat_id].append(params.get("text", ""))
+            self.condition.notify_all()
+        return 200, {"ok": True, "result": self.message(chat_id, params.get("text", ""))}
+
+    def api_editMessageText(self, token, params):
+        return 200, {"ok": True, "result": self.message(int(params["chat_id"]), params.get("text", ""))}
+
+    def api_answerCallbackQuery(self, token, params):
+        return 200, {"ok": True, "result": True}
+
+    def message(self, chat_id, text):
+        return {"message_id": next(self.message_ids), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": text}
+
+    def handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, как у настоящего API
+
+            def setup(self):
+                super().setup()
+                # Заголовки и тело уходят разными write: без NODELAY каждый ответ ждёт delayed ACK
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def do_GET(self):
+                self.dispatch()
+
+            def do_POST(self):
+                self.dispatch()
+
+            def dispatch(self):
+                url = urlsplit(self.path)
+                match = re.fullmatch(r"/bot([^/]+)/(\w+)", url.path)
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                if body and self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+                    params.update(parse_qsl(body.decode()))
+                if match:
+                    token, method = match.groups()
+                    status, payload = api.call(token, method, params)
+                else:
+                    status, payload = 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+                    method = None
+                with api.condition:
+                    api.calls[(method, status)] += 1
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
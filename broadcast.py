@@ -0,0 +1,389 @@
+import itertools
+import json
+import logging
+import queue
+import threading
+import time
+
+from telebot.apihelper import ApiTelegramException
+
+from posts import post_request, send_post
+from scheduler import Scheduler
+
+
+logger = logging.getLogger(__name__)
+
+
+def classify_failure(error):
+    """Why a chat can't receive messages: 'blocked', 'deactivated', 'not_found',
+    'migrated', or None if the error isn't about the recipient."""
+    if not isinstance(error, ApiTelegramException):
+        return None
+    description = (error.description or "").lower()
+    if error.error_code == 403:
+        # "bot was blocked by the user", "bot was kicked from the group chat", ...
+        return "deactivated" if "deactivated" in description else "blocked"
+    if error.error_code == 400:
+        if migrated_to(error):
+            return "migrated"
+        if "chat not found" in description or "user not found" in description:
+            return "not_found"
+    return None
+
+
+def migrated_to(error):
+    return (getattr(error, 'result_json', None) or {}).get('parameters', {}).get('migrate_to_chat_id')
+
+
+class TokenBucket:
+    """Global token bucket shared by every sending thread."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds` (used for retry_after)."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class ChatLimiter:
+    """Minimal interval between two messages to the same chat."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_allowed = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, chat_id):
+        with self.lock:
+            now = time.monotonic()
+            allowed = self.next_allowed.get(chat_id, now)
+            slot = max(now, allowed)
+            self.next_allowed[chat_id] = slot + self.interval
+            # Не даём словарю разрастаться на больших рассылках
+            if len(self.next_allowed) > 10000:
+                self.next_allowed = {cid: t for cid, t in self.next_allowed.items() if t > now}
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Broadcast:
+    """State of one running broadcast."""
+
+    def __init__(self, job_id, admin_chat_id, recipients, post, kwargs):
+        self.id = job_id
+        self.admin_chat_id = admin_chat_id
+        self.recipients = recipients
+        self.post = post
+        self.kwargs = kwargs
+        self.total = len(recipients)
+        self.delivered = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.status_message_id = None
+        self.last_report = self.started
+        self.lock = threading.Lock()
+        self.closed = False  # итог уже отправлен (завершена или отменена)
+        self.cancelled = False
+        self.done = threading.Event()
+
+    @property
+    def processed(self):
+        return self.delivered + self.failed
+
+
+class Broadcaster:
+    """Background fan-out of posts with rate limiting and progress reports.
+
+    With a store every job is persisted with a per-recipient outbox before
+    sending starts; delivery results are checkpointed through the store's
+    write queue, and resume() continues unfinished jobs after a restart.
+
+    With an AsyncTransport workers don't wait for the Bot API: they only
+    pace the sends, and results are handled by a separate thread.
+    """
+
+    def __init__(self, bot, workers=8, rate=30, per_chat_interval=1.0, report_interval=10, max_retries=3, metrics=None,
+                 store=None, on_undeliverable=None, transport=None, scheduler=None):
+        self.bot = bot
+        self.scheduler = scheduler or Scheduler()  # отложенные повторы после сетевых ошибок
+        self.metrics = metrics
+        self.store = store
+        self.transport = transport
+        if transport:
+            self.results = queue.Queue()  # (job, chat_id, attempt, future) завершённых отправок
+            self.in_flight = threading.Semaphore(transport.pool_size)
+        # on_undeliverable(chat_id, reason, new_chat_id): получатель недоступен или сменил id
+        self.on_undeliverable = on_undeliverable
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self.chat_limiter = ChatLimiter(per_chat_interval)
+        self.report_interval = report_interval
+        self.max_retries = max_retries
+        self.queue = queue.Queue()
+        self.reports = queue.Queue()  # (job, text, final) для чата администратора
+        self.threads = []
+        self.helpers = {}  # имя -> служебный поток (отчёты, результаты асинхронных отправок)
+        self.active = {}  # job_id -> незавершённая рассылка
+        self.job_ids = itertools.count(1)  # id рассылок, если нет хранилища
+        self.lock = threading.Lock()
+
+    def broadcast(self, admin_chat_id, recipients, post, **kwargs):
+        """Queue `post` (see posts.py) for every chat in `recipients` and return immediately."""
+        recipients = list(recipients)
+        if self.store:
+            job_id = self.store.add_broadcast(admin_chat_id, json.dumps(post), json.dumps(kwargs), recipients)
+        else:
+            job_id = next(self.job_ids)
+        job = Broadcast(job_id, admin_chat_id, recipients, post, kwargs)
+        self.start(job, f"Рассылка #{job.id} запущена: 0 из {job.total}.")
+        return job
+
+    def resume(self):
+        """Continue jobs that were running when the process stopped."""
+        for row, counts, pending in self.store.load_broadcasts():
+            job = Broadcast(row.id, row.admin_chat_id, pending, json.loads(row.payload), json.loads(row.options))
+            job.total = row.total
+            job.delivered = counts.get('delivered', 0)
+            job.failed = counts.get('failed', 0)
+            self.start(job, f"Рассылка #{job.id} возобновлена после перезапуска: "
+                            f"отправлено {job.processed} из {job.total}.")
+
+    def start(self, job, text):
+        self.ensure_workers()
+        self.active[job.id] = job
+        self.report(job, text)
+        if job.processed == job.total:
+            job.closed = True
+            self.finish(job)
+            return
+        for chat_id in job.recipients:
+            self.queue.put((job, chat_id, 0))
+        job.recipients = None  # очередь уже держит адресатов, второй список не нужен
+
+    def cancel(self, job_id):
+        """Stop a running job; recipients still in the queue are skipped."""
+        job = self.active.get(job_id)
+        if job is None:
+            return False
+        with job.lock:
+            if job.closed:
+                return False
+            job.closed = job.cancelled = True
+        self.finish(job)
+        return True
+
+    def ensure_workers(self):
+        with self.lock:
+            self.threads = [t for t in self.threads if t.is_alive()]
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.worker, name=f"broadcast-{len(self.threads)}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+            helpers = {"broadcast-reports": self.report_worker}
+            if self.transport:
+                helpers["broadcast-results"] = self.result_worker
+            for name, target in helpers.items():
+                thread = self.helpers.get(name)
+                if thread is None or not thread.is_alive():
+                    thread = self.helpers[name] = threading.Thread(target=target, name=name, daemon=True)
+                    thread.start()
+
+    def worker(self):
+        while True:
+            job, chat_id, attempt = self.queue.get()
+            if job.cancelled:
+                self.queue.task_done()
+                continue
+            try:
+                self.deliver(job, chat_id, attempt)
+            except Exception:
+                logger.exception("Broadcast worker failed on chat %s", chat_id)
+                self.record(job, chat_id, ok=False)
+            finally:
+                self.queue.task_done()
+
+    def deliver(self, job, chat_id, attempt):
+        self.chat_limiter.acquire(chat_id)
+        self.bucket.acquire()
+        if self.transport:
+            # Ответа не ждём: его обработает result_worker
+            self.in_flight.acquire()
+            future = self.transport.submit(*post_request(chat_id, job.post, **job.kwargs))
+            future.add_done_callback(lambda done: self.results.put((job, chat_id, attempt, done)))
+            return
+        try:
+            self.send(job, chat_id)
+        except Exception as e:
+            self.handle_error(job, chat_id, attempt, e)
+        else:
+            self.record(job, chat_id, ok=True)
+
+    def result_worker(self):
+        """Handle finished asynchronous sends outside the event loop thread."""
+        while True:
+            job, chat_id, attempt, future = self.results.get()
+            self.in_flight.release()
+            error = future.exception()
+            try:
+                if error is not None and migrated_to(error):
+                    self.resend_migrated(job, chat_id, migrated_to(error))
+                    error = None
+                if error is None:
+                    self.record(job, chat_id, ok=True)
+                else:
+                    self.handle_error(job, chat_id, attempt, error)
+            except Exception:
+                logger.exception("Broadcast result handling failed on chat %s", chat_id)
+                self.record(job, chat_id, ok=False)
+
+    def handle_error(self, job, chat_id, attempt, e):
+        if isinstance(e, ApiTelegramException):
+            if e.error_code == 429 and attempt < self.max_retries:
+                # Telegram просит подождать: останавливаем всех отправителей
+                retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+                self.bucket.pause(retry_after)
+                self.count("retried")
+                self.queue.put((job, chat_id, attempt + 1))
+                return
+            reason = classify_failure(e)
+            if reason:
+                self.count(reason)
+                if self.on_undeliverable:
+                    self.on_undeliverable(chat_id, reason, migrated_to(e))
+            logger.info("Broadcast to %s failed: %s", chat_id, e.description)
+            self.record(job, chat_id, ok=False)
+        elif attempt < self.max_retries:
+            # Сетевая ошибка: повторяем с задержкой, не занимая поток
+            self.count("retried")
+            self.scheduler.call_later(2 ** attempt, ("retry", job.id, chat_id), self.queue.put,
+                                      (job, chat_id, attempt + 1))
+        else:
+            logger.info("Broadcast to %s failed: %s", chat_id, e)
+            self.record(job, chat_id, ok=False)
+
+    def send(self, job, chat_id):
+        try:
+            send_post(self.bot, chat_id, job.post, **job.kwargs)
+        except ApiTelegramException as e:
+            new_chat_id = migrated_to(e)
+            if not new_chat_id:
+                raise
+            self.resend_migrated(job, chat_id, new_chat_id)
+
+    def resend_migrated(self, job, chat_id, new_chat_id):
+        # Группа стала супергруппой: сообщаем о новом id и сразу отправляем туда
+        self.count("migrated")
+        if self.on_undeliverable:
+            self.on_undeliverable(chat_id, "migrated", new_chat_id)
+        self.bucket.acquire()
+        send_post(self.bot, new_chat_id, job.post, **job.kwargs)
+
+    def count(self, result):
+        if self.metrics:
+            self.metrics.inc("broadcast_messages_total", result=result)
+
+    def record(self, job, chat_id, ok):
+        self.count("delivered" if ok else "failed")
+        if self.store:
+            # Контрольная точка: после перезапуска этот адресат уже не получит сообщение повторно
+            self.store.set_outbox_state(job.id, chat_id, 'delivered' if ok else 'failed')
+        with job.lock:
+            if ok:
+                job.delivered += 1
+            else:
+                job.failed += 1
+            finished = job.processed == job.total and not job.closed
+            if finished:
+                job.closed = True
+            now = time.monotonic()
+            report = not job.closed and now - job.last_report >= self.report_interval
+            if report:
+                job.last_report = now
+        if finished:
+            self.finish(job)
+        elif report:
+            self.report(job, f"Рассылка #{job.id}: отправлено {job.processed} из {job.total}.")
+
+    def finish(self, job):
+        elapsed = time.monotonic() - job.started
+        if self.store:
+            self.store.set_broadcast_status(job.id, 'cancelled' if job.cancelled else 'done')
+        if job.cancelled:
+            text = (f"Рассылка #{job.id} отменена.\n"
+                    f"Доставлено: {job.delivered}\n"
+                    f"Не доставлено: {job.failed}\n"
+                    f"Не отправлено: {job.total - job.processed}")
+        else:
+            text = (f"Рассылка #{job.id} завершена за {elapsed:.0f} с.\n"
+                    f"Доставлено: {job.delivered}\n"
+                    f"Не доставлено: {job.failed}")
+        self.report(job, text, final=True)
+        self.active.pop(job.id, None)
+        job.done.set()
+
+    def report(self, job, text, final=False):
+        """Queue a progress message for the admin chat without blocking the caller.
+
+        broadcast(), cancel() and resume() run on handler lanes and the
+        scheduler thread; waiting there for the rate limit would stall
+        unrelated chats.
+        """
+        self.reports.put((job, text, final))
+
+    def report_worker(self):
+        """Send or update progress messages in order, one job's messages after another."""
+        while True:
+            job, text, final = self.reports.get()
+            attempt = 0
+            while True:
+                self.bucket.acquire()
+                try:
+                    self.send_report(job, text, final)
+                    break
+                except ApiTelegramException as e:
+                    if e.error_code == 429:
+                        # Лимит исчерпан самой рассылкой: ждём и повторяем тот же отчёт, не теряя итог
+                        self.bucket.pause(e.result_json.get('parameters', {}).get('retry_after', 1))
+                        continue
+                    if "message is not modified" in e.description:
+                        break  # прогресс не изменился с прошлого отчёта
+                    error = e
+                except Exception as e:
+                    error = e
+                if attempt >= self.max_retries:
+                    logger.error("Failed to report broadcast progress: %s", error)
+                    break
+                attempt += 1
+                time.sleep(2 ** attempt)
+
+    def send_report(self, job, text, final):
+        if job.status_message_id and not final:
+            self.bot.edit_message_text(text, job.admin_chat_id, job.status_message_id)
+        else:
+            message = self.bot.send_message(job.admin_chat_id, text)
+            if not final:
+                job.status_message_id = message.message_id
@@ -0,0 +1,194 @@
+import itertools
+import logging
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from telebot.apihelper import ApiTelegramException
+
+from broadcast import TokenBucket
+
+
+logger = logging.getLogger(__name__)
+
+MAX_DIGEST_LENGTH = 4000  # лимит Telegram - 4096 символов на сообщение
+MAX_DESCRIPTION_LENGTH = 700  # полный текст остаётся в базе
+# Заголовок тикета в дайджесте: "#12 · 18.10 19:05 · пользователь 456"
+TICKET_HEADER = re.compile(r"^#(\d+) · ", re.MULTILINE)
+ANSWER = re.compile(r"#?(\d+)\s+(.+)", re.DOTALL)
+
+
+class Ticket:
+    def __init__(self, ticket_id, chat_id, description, group_ids, created_at):
+        self.id = ticket_id
+        self.chat_id = chat_id
+        self.description = description
+        self.group_ids = group_ids
+        self.created_at = created_at
+
+
+class ConsultationDesk:
+    """Consultation tickets delivered to the admin group as digests.
+
+    A ticket is stored before the user gets an ack. Telegram allows about
+    20 messages a minute to one group, so tickets are not posted one by
+    one: everything that accumulates while the rate limit is exhausted
+    goes out as a single digest.
+    """
+
+    def __init__(self, bot, group_chat_id, store=None, per_minute=20, burst=3, retry_interval=30,
+                 timezone=None, metrics=None):
+        self.bot = bot
+        self.group_chat_id = group_chat_id
+        self.store = store
+        self.metrics = metrics
+        self.timezone = timezone
+        self.bucket = TokenBucket(per_minute / 60, burst)
+        self.retry_interval = retry_interval
+        self.pending = deque()  # тикеты, ещё не попавшие в дайджест
+        self.open = {}  # ticket_id -> Ticket без ответа; отвеченные ищутся в хранилище
+        self.ids = itertools.count(1)  # id тикетов, если нет хранилища
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def submit(self, chat_id, description, group_ids, created_at=None):
+        """Register a request and queue it for the next digest."""
+        created_at = created_at or time.time()
+        if self.store:
+            ticket_id = self.store.add_consultation(chat_id, description, group_ids, created_at)
+        else:
+            ticket_id = next(self.ids)
+        ticket = Ticket(ticket_id, chat_id, description, group_ids, created_at)
+        self.enqueue(ticket)
+        if self.metrics:
+            self.metrics.inc("consultations_total")
+        return ticket
+
+    def load(self):
+        """Re-queue tickets accepted before a restart but never posted."""
+        for row in self.store.load_consultations():
+            self.enqueue(ticket_from_row(row))
+
+    def enqueue(self, ticket):
+        with self.condition:
+            self.open[ticket.id] = ticket
+            self.pending.append(ticket)
+            self.condition.notify()
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.worker, name="consultations", daemon=True)
+                self.thread.start()
+
+    def worker(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+            # Пока ждём разрешения лимита, новые тикеты копятся в тот же дайджест
+            self.bucket.acquire()
+            with self.condition:
+                batch = self.take_batch()
+            try:
+                self.post_digest(batch)
+            except Exception:
+                logger.exception("Consultation digest worker failed")
+                self.requeue(batch, self.retry_interval)
+
+    def take_batch(self):
+        batch, length = [], len(self.digest_title(0))
+        while self.pending:
+            entry = len(self.format_ticket(self.pending[0]))
+            if batch and length + entry > MAX_DIGEST_LENGTH:
+                break
+            batch.append(self.pending.popleft())
+            length += entry
+        return batch
+
+    def post_digest(self, batch):
+        try:
+            self.bot.send_message(self.group_chat_id, self.digest(batch))
+        except ApiTelegramException as e:
+            retry_after = self.retry_interval
+            if e.error_code == 429:
+                retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+            logger.warning("Consultation digest of %d tickets not sent: %s", len(batch), e.description)
+            self.requeue(batch, retry_after)
+            return
+        if self.store:
+            for ticket in batch:
+                self.store.set_consultation_status(ticket.id, 'notified')
+        if self.metrics:
+            self.metrics.inc("consultation_digests_total")
+
+    def requeue(self, batch, delay):
+        self.bucket.pause(delay)
+        with self.condition:
+            self.pending.extendleft(reversed(batch))
+
+    def digest_title(self, count):
+        return f"Новые запросы на консультацию: {count}\n\n"
+
+    def format_ticket(self, ticket):
+        created = datetime.fromtimestamp(ticket.created_at, self.timezone).strftime("%d.%m %H:%M")
+        description = ticket.description
+        if len(description) > MAX_DESCRIPTION_LENGTH:
+            description = description[:MAX_DESCRIPTION_LENGTH] + "…"
+        return (f"#{ticket.id} · {created} · пользователь {ticket.chat_id}\n"
+                f"Группы: {', '.join(ticket.group_ids)}\n"
+                f"{description}\n\n")
+
+    def digest(self, batch):
+        hint = ("Чтобы ответить, используйте 'Reply' на это сообщение"
+                + (" и начните ответ с номера запроса: #12 текст ответа." if len(batch) > 1 else "."))
+        return self.digest_title(len(batch)) + "".join(map(self.format_ticket, batch)) + hint
+
+    def find(self, ticket_id):
+        ticket = self.open.get(ticket_id)
+        if ticket is None and self.store:
+            row = self.store.get_consultation(ticket_id)
+            if row is not None:
+                ticket = ticket_from_row(row)
+        return ticket
+
+    def answer(self, ticket_id, text):
+        """Send an admin's answer to the ticket's author. Returns the ticket or None.
+
+        A ticket can be answered more than once, e.g. with a follow-up.
+        """
+        ticket = self.find(ticket_id)
+        if ticket is None:
+            return None
+        self.bot.send_message(ticket.chat_id, f"Ответ на ваш запрос №{ticket.id}:\n\n{text}")
+        self.open.pop(ticket.id, None)
+        if self.store:
+            self.store.set_consultation_status(ticket.id, 'answered')
+        return ticket
+
+    def backlog(self):
+        return len(self.pending)
+
+
+def ticket_from_row(row):
+    return Ticket(row.id, row.chat_id, row.description, row.group_ids.split(',') if row.group_ids else [],
+                  row.created_at)
+
+
+def is_digest(text):
+    """True for a digest text, i.e. one with at least one ticket header."""
+    return bool(TICKET_HEADER.search(text or ""))
+
+
+def parse_answer(text, replied_text=None):
+    """(ticket_id, answer) from an admin's message, or None.
+
+    "#12 текст" or "12 текст" after /reply; a reply to a digest with a
+    single ticket needs no number.
+    """
+    match = ANSWER.fullmatch(text.strip())
+    if match and (replied_text is None or text.lstrip().startswith("#")):
+        return int(match.group(1)), match.group(2).strip()
+    tickets = set(TICKET_HEADER.findall(replied_text or ""))
+    if len(tickets) == 1 and text.strip():
+        return int(tickets.pop()), text.strip()
+    return None
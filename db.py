@@ -1,20 +1,365 @@
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, MetaData
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from itertools import groupby
 
-DATABASE_URL = "sqlite:///subscriptions.db"
+from sqlalchemy import (create_engine, event, Column, BigInteger, Integer, String, DateTime, Float, Text,
+                        ForeignKey, Index, bindparam, delete, inspect, select, update, func)
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import declarative_base, sessionmaker
 
-engine = create_engine(DATABASE_URL)
+# Не DATABASE_URL: его выставляет Heroku для подключённого Postgres
+SQLITE_URL = os.environ.get("BOT_SQLITE_URL", "sqlite:///subscriptions.db")
+
+logger = logging.getLogger(__name__)
+
+engine = create_engine(SQLITE_URL)
 Base = declarative_base()
-metadata = MetaData()
 
-class Subscription(Base):
-    __tablename__ = 'subscriptions'
-    user_id = Column(Integer, primary_key=True, index=True)
-    news = Column(Boolean, default=False)
-    events = Column(Boolean, default=False)
-    updates = Column(Boolean, default=False)
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    # WAL позволяет читать во время записи, NORMAL - один fsync на checkpoint, а не на коммит
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+class Subscriber(Base):
+    __tablename__ = 'users'
+    chat_id = Column(BigInteger, primary_key=True)
+    contact = Column(String, nullable=True)
+    created_at = Column(DateTime, server_default=func.now())
+    # blocked / deactivated / not_found, если сообщения до пользователя не доходят
+    inactive_reason = Column(String, nullable=True)
+    inactive_since = Column(Float, nullable=True)
+
+
+class Group(Base):
+    __tablename__ = 'groups'
+    group_id = Column(String, primary_key=True)
+    name = Column(String, nullable=False)
+
+
+class Membership(Base):
+    __tablename__ = 'memberships'
+    chat_id = Column(BigInteger, ForeignKey('users.chat_id', ondelete='CASCADE'), primary_key=True)
+    group_id = Column(String, ForeignKey('groups.group_id', ondelete='CASCADE'), primary_key=True)
+    __table_args__ = (Index('ix_memberships_group_id', 'group_id'),)
+
+
+class AdminAccount(Base):
+    __tablename__ = 'admins'
+    chat_id = Column(BigInteger, primary_key=True)
+    role = Column(String, nullable=False, default='admin')
+
+
+class Setting(Base):
+    __tablename__ = 'settings'
+    key = Column(String, primary_key=True)
+    value = Column(String, nullable=False)
+
+
+class ScheduledBroadcast(Base):
+    __tablename__ = 'scheduled_broadcasts'
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    admin_chat_id = Column(BigInteger, nullable=False)
+    group_id = Column(String, nullable=False)
+    text = Column(Text, nullable=False)
+    payload = Column(Text, nullable=True)  # JSON поста (posts.py), для медиа и альбомов
+    send_at = Column(Float, nullable=False)  # unix time
+    status = Column(String, nullable=False, default='pending')
+    __table_args__ = (Index('ix_scheduled_broadcasts_status', 'status'),)
+
+
+class BroadcastJob(Base):
+    __tablename__ = 'broadcast_jobs'
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    admin_chat_id = Column(BigInteger, nullable=False)
+    payload = Column(Text, nullable=False)  # JSON поста (posts.py)
+    options = Column(Text, nullable=False, default='{}')  # JSON параметров отправки (parse_mode)
+    total = Column(Integer, nullable=False)
+    created_at = Column(Float, nullable=False)  # unix time
+    status = Column(String, nullable=False, default='running')  # running -> done | cancelled
+    __table_args__ = (Index('ix_broadcast_jobs_status', 'status'),)
+
+
+class OutboxEntry(Base):
+    """One recipient of a broadcast job; doubles as the delivery log."""
+    __tablename__ = 'broadcast_outbox'
+    job_id = Column(BigInteger, ForeignKey('broadcast_jobs.id', ondelete='CASCADE'), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
+    state = Column(String, nullable=False, default='pending')  # pending -> delivered | failed
+
+
+class ConsultationTicket(Base):
+    __tablename__ = 'consultations'
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    chat_id = Column(BigInteger, nullable=False)
+    description = Column(Text, nullable=False)
+    group_ids = Column(String, nullable=False, default='')  # через запятую, на момент запроса
+    created_at = Column(Float, nullable=False)  # unix time
+    status = Column(String, nullable=False, default='queued')  # queued -> notified -> answered
+    __table_args__ = (Index('ix_consultations_status', 'status'),)
+
 
 Base.metadata.create_all(bind=engine)
 
+
+def add_missing_columns(bind):
+    """create_all doesn't alter existing tables; add nullable columns introduced later."""
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    column_type = column.type.compile(dialect=bind.dialect)
+                    conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+
+
+add_missing_columns(engine)
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+users = Subscriber.__table__
+groups = Group.__table__
+memberships = Membership.__table__
+admins = AdminAccount.__table__
+settings = Setting.__table__
+scheduled = ScheduledBroadcast.__table__
+consultations = ConsultationTicket.__table__
+broadcast_jobs = BroadcastJob.__table__
+outbox = OutboxEntry.__table__
+
+_insert_user = insert(users)
+_insert_group = insert(groups)
+_insert_admin = insert(admins)
+_insert_setting = insert(settings)
+
+# Операции, которые очередь записи применяет пачкой (executemany) внутри одной транзакции
+STATEMENTS = {
+    # Любая подписка означает, что пользователь снова доступен
+    'save_user': _insert_user.on_conflict_do_update(
+        index_elements=['chat_id'], set_={'inactive_reason': None, 'inactive_since': None}),
+    'delete_user': delete(users).where(users.c.chat_id == bindparam('b_chat_id')),
+    'set_inactive': update(users).where(users.c.chat_id == bindparam('b_chat_id')),
+    'clear_memberships': delete(memberships).where(memberships.c.chat_id == bindparam('b_chat_id')),
+    'add_membership': insert(memberships).on_conflict_do_nothing(),
+    'save_group': _insert_group.on_conflict_do_update(
+        index_elements=['group_id'], set_={'name': _insert_group.excluded.name}),
+    'save_admin': _insert_admin.on_conflict_do_update(
+        index_elements=['chat_id'], set_={'role': _insert_admin.excluded.role}),
+    'save_setting': _insert_setting.on_conflict_do_update(
+        index_elements=['key'], set_={'value': _insert_setting.excluded.value}),
+    'set_scheduled_status': update(scheduled).where(scheduled.c.id == bindparam('b_id')),
+    'set_consultation_status': update(consultations).where(consultations.c.id == bindparam('b_id')),
+    'set_broadcast_status': update(broadcast_jobs).where(broadcast_jobs.c.id == bindparam('b_id')),
+    'set_outbox_state': update(outbox).where(
+        (outbox.c.job_id == bindparam('b_job_id')) & (outbox.c.chat_id == bindparam('b_chat_id'))),
+}
+
+
+class Store:
+    """Write-behind storage: state is preloaded once, changes are committed in batches."""
+
+    def __init__(self, bind=engine, batch_size=500, flush_interval=0.5, retries=5, retry_delay=0.2):
+        self.engine = bind
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop, name="db-writer", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def load(self):
+        """Read groups, subscribers with their groups, admins and inactive chat ids."""
+        with self.engine.connect() as conn:
+            loaded_groups = {row.group_id: row.name for row in conn.execute(select(groups))}
+            subscribers = {row.chat_id: [] for row in conn.execute(select(users.c.chat_id))}
+            for row in conn.execute(select(memberships).order_by(memberships.c.chat_id)):
+                subscribers.setdefault(row.chat_id, []).append(row.group_id)
+            loaded_admins = {row.chat_id: row.role for row in conn.execute(select(admins))}
+            inactive = set(conn.execute(select(users.c.chat_id).where(users.c.inactive_reason.is_not(None))).scalars())
+        return loaded_groups, subscribers, loaded_admins, inactive
+
+    def save_subscriber(self, chat_id, group_ids):
+        """Replace the stored memberships of a subscriber."""
+        self.put('save_user', {'chat_id': chat_id})
+        self.put('clear_memberships', {'b_chat_id': chat_id})
+        for group_id in group_ids:
+            self.put('add_membership', {'chat_id': chat_id, 'group_id': group_id})
+
+    def add_membership(self, chat_id, group_id):
+        self.put('save_user', {'chat_id': chat_id})
+        self.put('add_membership', {'chat_id': chat_id, 'group_id': group_id})
+
+    def set_inactive(self, chat_id, reason):
+        self.put('set_inactive', {'b_chat_id': chat_id, 'inactive_reason': reason, 'inactive_since': time.time()})
+
+    def migrate_subscriber(self, old_chat_id, new_chat_id, group_ids):
+        """Move a subscriber to a new chat id (group upgraded to a supergroup)."""
+        self.save_subscriber(new_chat_id, group_ids)
+        self.put('delete_user', {'b_chat_id': old_chat_id})
+
+    def inactive_counts(self, since=None):
+        """{reason: count} of inactive subscribers, optionally only those marked after `since`."""
+        query = select(users.c.inactive_reason, func.count()).where(users.c.inactive_reason.is_not(None))
+        if since is not None:
+            query = query.where(users.c.inactive_since >= since)
+        with self.engine.connect() as conn:
+            return dict(conn.execute(query.group_by(users.c.inactive_reason)).all())
+
+    def save_group(self, group_id, name):
+        self.put('save_group', {'group_id': group_id, 'name': name})
+
+    def save_admin(self, chat_id, role):
+        self.put('save_admin', {'chat_id': chat_id, 'role': role})
+
+    def get_setting(self, key, default=None):
+        with self.engine.connect() as conn:
+            value = conn.execute(select(settings.c.value).where(settings.c.key == key)).scalar()
+        return default if value is None else value
+
+    def set_setting(self, key, value):
+        self.put('save_setting', {'key': key, 'value': str(value)})
+
+    def add_scheduled(self, admin_chat_id, group_id, text, payload, send_at):
+        """Store a scheduled broadcast right away and return its id."""
+        with self.engine.begin() as conn:
+            result = conn.execute(scheduled.insert().values(
+                admin_chat_id=admin_chat_id, group_id=group_id, text=text, payload=payload,
+                send_at=send_at, status='pending'))
+            return result.inserted_primary_key[0]
+
+    def set_scheduled_status(self, scheduled_id, status):
+        self.put('set_scheduled_status', {'b_id': scheduled_id, 'status': status})
+
+    def load_scheduled(self):
+        with self.engine.connect() as conn:
+            return conn.execute(select(scheduled).where(scheduled.c.status == 'pending')).all()
+
+    def add_broadcast(self, admin_chat_id, payload, options, recipients):
+        """Store a broadcast job and its outbox in one transaction and return the job id."""
+        with self.engine.begin() as conn:
+            result = conn.execute(broadcast_jobs.insert().values(
+                admin_chat_id=admin_chat_id, payload=payload, options=options, total=len(recipients),
+                created_at=time.time(), status='running'))
+            job_id = result.inserted_primary_key[0]
+            if recipients:
+                conn.execute(outbox.insert(), [{'job_id': job_id, 'chat_id': chat_id, 'state': 'pending'}
+                                               for chat_id in recipients])
+            return job_id
+
+    def set_outbox_state(self, job_id, chat_id, state):
+        self.put('set_outbox_state', {'b_job_id': job_id, 'b_chat_id': chat_id, 'state': state})
+
+    def set_broadcast_status(self, job_id, status):
+        self.put('set_broadcast_status', {'b_id': job_id, 'status': status})
+
+    def load_broadcasts(self):
+        """Unfinished jobs as (row, {state: count}, pending chat ids)."""
+        jobs = []
+        with self.engine.connect() as conn:
+            for row in conn.execute(select(broadcast_jobs).where(broadcast_jobs.c.status == 'running')
+                                    .order_by(broadcast_jobs.c.id)).all():
+                counts = dict(conn.execute(select(outbox.c.state, func.count())
+                                           .where(outbox.c.job_id == row.id).group_by(outbox.c.state)).all())
+                pending = conn.execute(select(outbox.c.chat_id).where(
+                    (outbox.c.job_id == row.id) & (outbox.c.state == 'pending'))).scalars().all()
+                jobs.append((row, counts, pending))
+        return jobs
+
+    def add_consultation(self, chat_id, description, group_ids, created_at):
+        """Store a consultation ticket right away and return its id."""
+        with self.engine.begin() as conn:
+            result = conn.execute(consultations.insert().values(
+                chat_id=chat_id, description=description, group_ids=','.join(group_ids),
+                created_at=created_at, status='queued'))
+            return result.inserted_primary_key[0]
+
+    def set_consultation_status(self, ticket_id, status):
+        self.put('set_consultation_status', {'b_id': ticket_id, 'status': status})
+
+    def load_consultations(self, status='queued'):
+        with self.engine.connect() as conn:
+            return conn.execute(select(consultations).where(consultations.c.status == status)
+                                .order_by(consultations.c.id)).all()
+
+    def get_consultation(self, ticket_id):
+        with self.engine.connect() as conn:
+            return conn.execute(select(consultations).where(consultations.c.id == ticket_id)).first()
+
+    def put(self, op, params):
+        self.queue.put((op, params))
+
+    def flush(self):
+        """Block until everything queued so far is committed."""
+        self.queue.join()
+
+    def close(self):
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            batch = [item]
+            # Собираем всё, что успело накопиться, но не дольше flush_interval
+            deadline = time.monotonic() + self.flush_interval
+            while item is not None and len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(item)
+            ops = [op for op in batch if op is not None]
+            try:
+                if ops:
+                    self.commit(ops)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if len(ops) < len(batch):
+                return
+
+    def commit(self, ops):
+        """Write a batch; if it keeps failing, write the ops one by one so only broken ones are lost."""
+        if self.attempt(ops):
+            return
+        for op, params in ops:
+            if not self.attempt([(op, params)]):
+                logger.error("Dropped queued change %s %r", op, params)
+
+    def attempt(self, ops):
+        # "database is locked" и подобные ошибки SQLite проходят сами - повторяем с паузой
+        for attempt in range(self.retries):
+            try:
+                self.write_batch(ops)
+                return True
+            except OperationalError:
+                logger.warning("Failed to write %d queued changes, attempt %d", len(ops), attempt + 1,
+                               exc_info=True)
+                time.sleep(self.retry_delay * 2 ** attempt)
+            except Exception:
+                logger.exception("Failed to write %d queued changes", len(ops))
+                return False
+        return False
+
+    def write_batch(self, ops):
+        with self.engine.begin() as conn:
+            for op, run in groupby(ops, key=lambda item: item[0]):
+                conn.execute(STATEMENTS[op], [params for _, params in run])
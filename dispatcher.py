@@ -0,0 +1,59 @@
+import logging
+import queue
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+def update_chat_id(update):
+    """Chat the update belongs to, used to pick its lane."""
+    for message in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if message is not None:
+            return message.chat.id
+    if update.callback_query is not None:
+        if update.callback_query.message is not None:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return update.update_id
+
+
+class ChatDispatcher:
+    """Processes updates on N serial lanes chosen by chat id.
+
+    Updates of one chat always land on the same lane and run strictly in
+    order; different chats run in parallel on different lanes. Each lane
+    has a bounded queue, so a flood of updates pushes back on the caller.
+    """
+
+    def __init__(self, bot, lanes=8, lane_size=100):
+        self.bot = bot
+        self.lanes = [queue.Queue(maxsize=lane_size) for _ in range(lanes)]
+        for number, lane in enumerate(self.lanes):
+            threading.Thread(target=self.worker, args=(lane,), name=f"lane-{number}", daemon=True).start()
+
+    def submit(self, update, block=True, timeout=None):
+        """Queue an update on its chat's lane. Returns False if the lane is full."""
+        lane = self.lanes[update_chat_id(update) % len(self.lanes)]
+        try:
+            lane.put(update, block, timeout)
+        except queue.Full:
+            return False
+        return True
+
+    def depths(self):
+        return [lane.qsize() for lane in self.lanes]
+
+    def join(self):
+        for lane in self.lanes:
+            lane.join()
+
+    def worker(self, lane):
+        while True:
+            update = lane.get()
+            try:
+                self.bot.process_new_updates([update])
+            except Exception:
+                logger.exception("Failed to process update %s", update.update_id)
+            finally:
+                lane.task_done()
@@ -0,0 +1,170 @@
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+from telebot.apihelper import ApiTelegramException
+
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Методы TeleBot, вызовы которых считаются по методу и статусу ответа
+API_METHODS = (
+    "send_message", "send_photo", "send_video", "send_animation", "send_document", "send_audio",
+    "send_voice", "send_media_group", "edit_message_text", "answer_callback_query", "get_updates",
+    "get_me", "set_webhook", "delete_webhook",
+)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """In-process counters, histograms and gauges in Prometheus text format.
+
+    Every recorded value is also passed to the optional sinks, callables
+    taking (kind, name, labels, value), for forwarding to statsd and the like.
+    """
+
+    def __init__(self, prefix="bot", sinks=()):
+        self.prefix = prefix
+        self.sinks = list(sinks)
+        self.counters = {}  # (name, labels) -> значение
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.gauges = {}  # name -> функция, возвращающая текущее значение
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.emit("counter", name, labels, value)
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+        self.emit("histogram", name, labels, value)
+
+    def gauge(self, name, read):
+        """Register a gauge read from `read()` at scrape time."""
+        self.gauges[name] = read
+
+    def emit(self, kind, name, labels, value):
+        for sink in self.sinks:
+            try:
+                sink(kind, name, labels, value)
+            except Exception:
+                logger.exception("Metrics sink failed")
+
+    def timed(self, name, function, **labels):
+        """Wrap `function` so each call is observed in histogram `name`."""
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.observe(name, time.perf_counter() - started, **labels)
+        return wrapper
+
+    def instrument_handlers(self, router):
+        """Time every handler registered in the router."""
+        router.wrap(lambda function: self.timed("handler_seconds", function, handler=function.__name__))
+
+    def instrument_api(self, bot):
+        """Count Bot API calls made through `bot` by method and result."""
+        for method in API_METHODS:
+            setattr(bot, method, self.counted(method, getattr(bot, method)))
+
+    def counted(self, method, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            status = "ok"
+            try:
+                return function(*args, **kwargs)
+            except ApiTelegramException as e:
+                status = str(e.error_code)
+                raise
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                self.inc("api_calls_total", method=method, status=status)
+                self.observe("api_call_seconds", time.perf_counter() - started, method=method)
+        return wrapper
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(h.counts), h.sum, h.count)) for key, h in self.histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {self.prefix}_{name} counter")
+            lines.append(f"{self.prefix}_{name}{format_labels(labels)} {value}")
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {self.prefix}_{name} histogram")
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS + ("+Inf",), counts):
+                cumulative += bucket
+                lines.append(f"{self.prefix}_{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.prefix}_{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{self.prefix}_{name}_count{format_labels(labels)} {count}")
+        for name, read in sorted(self.gauges.items()):
+            try:
+                value = read()
+            except Exception:
+                logger.exception("Failed to read gauge %s", name)
+                continue
+            lines.append(f"# TYPE {self.prefix}_{name} gauge")
+            lines.append(f"{self.prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def __call__(self, environ, start_response):
+        """Minimal WSGI app that serves render() on any path."""
+        body = self.render().encode()
+        start_response("200 OK", [("Content-Type", "text/plain; version=0.0.4"), ("Content-Length", str(len(body)))])
+        return [body]
+
+    def serve(self, port):
+        """Serve /metrics on `port` from a background thread (polling mode)."""
+        server = make_server("", port, self, handler_class=QuietHandler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        return server
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
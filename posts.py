@@ -0,0 +1,107 @@
+"""Broadcast payloads ("posts") built from an admin's message.
+
+A post is a plain dict so it can be stored as JSON:
+
+    {"type": "text", "text": "..."}
+    {"type": "voice", "file_id": "...", "caption": "..."}
+    {"type": "album", "items": [{"type": "photo", "file_id": "...", "caption": "..."}, ...]}
+
+Media is never re-uploaded: the admin's upload already lives on Telegram's
+servers, so every recipient gets the same file_id reference.
+"""
+import copy
+import json
+
+from telebot import types
+
+
+MEDIA_TYPES = ("photo", "video", "animation", "document", "audio", "voice")
+# Приходят в обработчик, чтобы админ получил ответ, но разослать их нельзя
+UNSUPPORTED_TYPES = ("sticker", "video_note", "location", "venue", "contact", "poll", "dice")
+
+# Типы, которые Telegram умеет объединять в альбом
+ALBUM_MEDIA = {
+    "photo": types.InputMediaPhoto,
+    "video": types.InputMediaVideo,
+    "document": types.InputMediaDocument,
+    "audio": types.InputMediaAudio,
+}
+
+
+def media_item(message):
+    """Media part of a message as a post item, or None for unsupported content."""
+    if message.content_type not in MEDIA_TYPES:
+        return None
+    media = getattr(message, message.content_type)
+    if message.content_type == "photo":
+        media = media[-1]  # самый крупный размер
+    return {"type": message.content_type, "file_id": media.file_id, "caption": message.caption}
+
+
+def post_from_message(message):
+    if message.content_type == "text":
+        return {"type": "text", "text": message.text}
+    item = media_item(message)
+    if item and message.media_group_id and item["type"] in ALBUM_MEDIA:
+        return {"type": "album", "items": [item]}
+    return item
+
+
+def add_to_album(post, message):
+    """Append the next message of a media group. Returns False if it can't be added."""
+    item = media_item(message)
+    if post.get("type") != "album" or item is None or item["type"] not in ALBUM_MEDIA or len(post["items"]) >= 10:
+        return False
+    post["items"].append(item)
+    return True
+
+
+def post_text(post):
+    """Text or caption shown in previews and digests."""
+    if post["type"] == "text":
+        return post["text"]
+    items = post["items"] if post["type"] == "album" else [post]
+    return next((item["caption"] for item in items if item.get("caption")), "")
+
+
+def with_footer(post, footer):
+    """Copy of the post with `footer` appended to its text or first caption."""
+    post = copy.deepcopy(post)
+    if post["type"] == "text":
+        post["text"] += footer
+        return post
+    item = post["items"][0] if post["type"] == "album" else post
+    item["caption"] = ((item.get("caption") or "") + footer).strip()
+    return post
+
+
+def describe(post):
+    if post["type"] == "album":
+        return f"альбом из {len(post['items'])} файлов"
+    return {"text": "текст", "photo": "фото", "video": "видео", "animation": "анимация",
+            "document": "документ", "audio": "аудио", "voice": "голосовое сообщение"}[post["type"]]
+
+
+def send_post(bot, chat_id, post, parse_mode=None):
+    """Send a post to one chat using only file_id references."""
+    if post["type"] == "text":
+        return bot.send_message(chat_id, post["text"], parse_mode=parse_mode)
+    if post["type"] == "album":
+        media = [ALBUM_MEDIA[item["type"]](item["file_id"], caption=item.get("caption"), parse_mode=parse_mode)
+                 for item in post["items"]]
+        return bot.send_media_group(chat_id, media)
+    send = getattr(bot, f"send_{post['type']}")
+    return send(chat_id, post["file_id"], caption=post.get("caption"), parse_mode=parse_mode)
+
+
+def post_request(chat_id, post, parse_mode=None):
+    """(Bot API method, params) that send_post would use, for raw HTTP clients."""
+    if post["type"] == "text":
+        return "sendMessage", {"chat_id": chat_id, "text": post["text"], "parse_mode": parse_mode}
+    if post["type"] == "album":
+        media = [{"type": item["type"], "media": item["file_id"], "caption": item.get("caption"), "parse_mode": parse_mode}
+                 for item in post["items"]]
+        media = [{key: value for key, value in item.items() if value is not None} for item in media]
+        return "sendMediaGroup", {"chat_id": chat_id, "media": json.dumps(media)}
+    method = "send" + post["type"].capitalize()
+    return method, {"chat_id": chat_id, post["type"]: post["file_id"], "caption": post.get("caption"), "parse_mode": parse_mode}
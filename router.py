@@ -0,0 +1,87 @@
+class Router:
+    """Dict-based routing table for commands and callback data.
+
+    Telebot only sees one message handler and one callback handler; the
+    router picks the target with a single dict lookup, so the cost per
+    update does not grow with the number of commands or groups.
+
+    Callback data is either an exact key ("confirm_send") or
+    "<route>:<param>", where param is converted by the route's type.
+    """
+
+    def __init__(self):
+        self.commands = {}  # "start" -> handler(message)
+        self.callbacks = {}  # "confirm_send" -> handler(call)
+        self.param_callbacks = {}  # "subscribe" -> (handler(call, param), тип параметра)
+        self.legacy_prefixes = []  # (prefix, route) для кнопок старого формата "subscribe_<id>"
+        self.text = None  # обработчик сообщений без команды
+
+    def command(self, name, handler):
+        self.commands[name] = handler
+
+    def callback(self, data, handler):
+        self.callbacks[data] = handler
+
+    def callback_param(self, route, handler, param=str, legacy_prefix=None):
+        self.param_callbacks[route] = (handler, param)
+        if legacy_prefix:
+            self.legacy_prefixes.append((legacy_prefix, route))
+
+    def fallback(self, handler):
+        self.text = handler
+
+    @staticmethod
+    def data(route, param):
+        """Callback data for a parametrized route."""
+        return f"{route}:{param}"
+
+    def resolve_message(self, message):
+        text = message.text or ""
+        if text.startswith("/"):
+            # "/start@bot_name payload" -> "start", как telebot.util.extract_command
+            name = text.split(maxsplit=1)[0][1:].split("@", 1)[0]
+            handler = self.commands.get(name)
+            if handler:
+                return handler, ()
+        return self.text, ()
+
+    def resolve_callback(self, call):
+        data = call.data or ""
+        handler = self.callbacks.get(data)
+        if handler:
+            return handler, ()
+        route, sep, raw = data.partition(":")
+        if not sep:
+            # Кнопки из сообщений, отправленных до перехода на "route:param"
+            for prefix, legacy_route in self.legacy_prefixes:
+                if data.startswith(prefix):
+                    route, raw = legacy_route, data[len(prefix):]
+                    break
+            else:
+                return None, ()
+        entry = self.param_callbacks.get(route)
+        if entry is None:
+            return None, ()
+        handler, param = entry
+        try:
+            return handler, (param(raw),)
+        except ValueError:
+            return None, ()
+
+    def route_message(self, message):
+        handler, args = self.resolve_message(message)
+        if handler:
+            handler(message, *args)
+
+    def route_callback(self, call):
+        handler, args = self.resolve_callback(call)
+        if handler:
+            handler(call, *args)
+
+    def wrap(self, wrapper):
+        """Replace every handler with wrapper(handler), e.g. for timing."""
+        self.commands = {name: wrapper(handler) for name, handler in self.commands.items()}
+        self.callbacks = {data: wrapper(handler) for data, handler in self.callbacks.items()}
+        self.param_callbacks = {route: (wrapper(handler), param) for route, (handler, param) in self.param_callbacks.items()}
+        if self.text:
+            self.text = wrapper(self.text)
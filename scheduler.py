@@ -0,0 +1,71 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """Runs delayed callbacks from a single thread using a heap of deadlines.
+
+    Callbacks run on the scheduler thread, so they should only do short work
+    (send a message, queue a broadcast).
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.entries = {}  # key -> запись в куче, чтобы заменять и отменять таймеры
+        self.counter = itertools.count()
+        self.cancelled = 0
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="scheduler", daemon=True)
+        self.thread.start()
+
+    def call_at(self, when, key, callback, *args):
+        """Run `callback(*args)` at unix time `when`, replacing any entry with the same key."""
+        entry = [when, next(self.counter), key, callback, args]
+        with self.condition:
+            self.discard(key)
+            self.entries[key] = entry
+            heapq.heappush(self.heap, entry)
+            # Будим поток, только если новый срок раньше текущего ожидания
+            if self.heap[0] is entry:
+                self.condition.notify()
+        return entry
+
+    def call_later(self, delay, key, callback, *args):
+        return self.call_at(time.time() + delay, key, callback, *args)
+
+    def cancel(self, key):
+        with self.condition:
+            self.discard(key)
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            # Ленивое удаление: запись остаётся в куче, но уже ничего не вызывает
+            entry[3] = None
+            self.cancelled += 1
+            if self.cancelled > 64 and self.cancelled * 2 > len(self.heap):
+                self.heap = [item for item in self.heap if item[3] is not None]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.time():
+                    timeout = self.heap[0][0] - time.time() if self.heap else None
+                    self.condition.wait(timeout)
+                when, _, key, callback, args = heapq.heappop(self.heap)
+                if callback is None:
+                    self.cancelled -= 1
+                    continue
+                del self.entries[key]
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception("Scheduled callback %r failed", key)
@@ -0,0 +1,161 @@
+import threading
+from array import array
+from bisect import bisect_left
+
+
+# Маска хранится в беззнаковом 64-битном слове, старший бит занят под флаг недоступности
+MAX_GROUPS = 63
+INACTIVE = 1 << 63
+
+
+class SubscriberTable:
+    """Compact subscriber storage: chat ids with group membership bitmasks.
+
+    Group ids are interned into bit numbers. Subscribers live in two
+    parallel sorted arrays (chat id, mask), about 16 bytes per user; new
+    chat ids are collected in a small dict and merged into the arrays in
+    batches, so inserts stay cheap.
+
+    Subscribers who can't be reached (blocked the bot, deleted account)
+    keep their groups but carry the INACTIVE bit and are left out of
+    audience(); subscribing again clears it.
+    """
+
+    def __init__(self, merge_threshold=4096):
+        self.group_bits = {}  # group_id -> номер бита
+        self.group_ids = []  # номер бита -> group_id
+        self.ids = array('q')
+        self.masks = array('Q')
+        self.pending = {}  # chat_id -> mask, ещё не слитые в массивы
+        self.merge_threshold = merge_threshold
+        self.lock = threading.RLock()
+
+    def intern(self, group_id):
+        """Bit mask of a group, allocating a new bit for unseen groups."""
+        with self.lock:
+            bit = self.group_bits.get(group_id)
+            if bit is None:
+                if len(self.group_ids) >= MAX_GROUPS:
+                    raise ValueError(f"no more than {MAX_GROUPS} groups are supported")
+                bit = self.group_bits[group_id] = len(self.group_ids)
+                self.group_ids.append(group_id)
+            return 1 << bit
+
+    def mask_of(self, group_ids):
+        mask = 0
+        for group_id in group_ids:
+            mask |= self.intern(group_id)
+        return mask
+
+    def groups_of(self, mask):
+        return [group_id for bit, group_id in enumerate(self.group_ids) if mask >> bit & 1]
+
+    def is_active(self, chat_id):
+        mask = self.get(chat_id)
+        return mask is not None and not mask & INACTIVE
+
+    def get(self, chat_id):
+        """Mask of a subscriber, or None if the chat is unknown."""
+        with self.lock:
+            mask = self.pending.get(chat_id)
+            if mask is not None:
+                return mask
+            i = bisect_left(self.ids, chat_id)
+            if i < len(self.ids) and self.ids[i] == chat_id:
+                return self.masks[i]
+            return None
+
+    def set(self, chat_id, mask):
+        with self.lock:
+            i = bisect_left(self.ids, chat_id)
+            if i < len(self.ids) and self.ids[i] == chat_id:
+                self.masks[i] = mask
+                return
+            self.pending[chat_id] = mask
+            if len(self.pending) >= self.merge_threshold:
+                self.merge()
+
+    def add(self, chat_id, mask, default=0):
+        """OR `mask` into a subscriber's groups (creating it with `default`).
+
+        Returns False if the subscriber already had all of those groups
+        and was active.
+        """
+        with self.lock:
+            current = self.get(chat_id)
+            if current is None:
+                current = default
+            elif current & (mask | INACTIVE) == mask:
+                return False
+            self.set(chat_id, (current | mask) & ~INACTIVE)
+            return True
+
+    def deactivate(self, chat_id):
+        """Exclude a subscriber from audiences. Returns False if unknown or already inactive."""
+        with self.lock:
+            mask = self.get(chat_id)
+            if mask is None or mask & INACTIVE:
+                return False
+            self.set(chat_id, mask | INACTIVE)
+            return True
+
+    def remove(self, chat_id):
+        """Forget a subscriber and return its mask (None if unknown)."""
+        with self.lock:
+            mask = self.pending.pop(chat_id, None)
+            if mask is not None:
+                return mask
+            i = bisect_left(self.ids, chat_id)
+            if i < len(self.ids) and self.ids[i] == chat_id:
+                mask = self.masks[i]
+                del self.ids[i]
+                del self.masks[i]
+                return mask
+            return None
+
+    def load(self, rows):
+        """Bulk-load (chat_id, mask) pairs."""
+        with self.lock:
+            for chat_id, mask in rows:
+                self.pending[chat_id] = mask
+            self.merge()
+
+    def merge(self):
+        """Fold pending chat ids into the sorted arrays in one linear pass."""
+        with self.lock:
+            if not self.pending:
+                return
+            ids, masks = array('q'), array('Q')
+            start = 0
+            for chat_id, mask in sorted(self.pending.items()):
+                end = bisect_left(self.ids, chat_id, start)
+                ids.extend(self.ids[start:end])
+                masks.extend(self.masks[start:end])
+                if end < len(self.ids) and self.ids[end] == chat_id:
+                    end += 1  # запись из pending заменяет старую
+                ids.append(chat_id)
+                masks.append(mask)
+                start = end
+            ids.extend(self.ids[start:])
+            masks.extend(self.masks[start:])
+            self.ids, self.masks = ids, masks
+            self.pending = {}
+
+    def audience(self, mask):
+        """Active chat ids whose groups intersect `mask`."""
+        with self.lock:
+            result = [chat_id for chat_id, groups in zip(self.ids, self.masks) if groups & mask and not groups & INACTIVE]
+            result.extend(chat_id for chat_id, groups in self.pending.items() if groups & mask and not groups & INACTIVE)
+        return result
+
+    def count_inactive(self):
+        with self.lock:
+            return (sum(1 for groups in self.masks if groups & INACTIVE)
+                    + sum(1 for groups in self.pending.values() if groups & INACTIVE))
+
+    def __contains__(self, chat_id):
+        return self.get(chat_id) is not None
+
+    def __len__(self):
+        with self.lock:
+            return len(self.ids) + len(self.pending)
@@ -0,0 +1,102 @@
+import asyncio
+import re
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
+
+DEFAULT_API_URL = "https://api.telegram.org/bot{0}/{1}"
+
+
+class PooledTransport:
+    """One keep-alive connection pool shared by every thread that calls the Bot API.
+
+    By default telebot keeps a requests.Session per thread and recreates it
+    every SESSION_TIME_TO_LIVE seconds, so each lane and broadcast worker
+    holds its own connection and periodically repeats the TLS handshake.
+    install() routes all telebot requests through a single pool instead.
+    """
+
+    def __init__(self, pool_size=32, connect_timeout=5, read_timeout=30):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.session = requests.Session()
+        # pool_block: лишние потоки ждут свободное соединение, а не открывают новое
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def install(self):
+        """Make telebot send every request through this pool (process-wide)."""
+        apihelper.CONNECT_TIMEOUT = self.connect_timeout
+        apihelper.READ_TIMEOUT = self.read_timeout
+        apihelper.CUSTOM_REQUEST_SENDER = self.request
+
+    def request(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        # Таймауты считает telebot: для getUpdates чтение дольше long polling
+        return self.session.request(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncTransport(PooledTransport):
+    """Pooled transport plus an asyncio client for fire-and-forget sends.
+
+    submit() schedules a Bot API call on an event loop running in a
+    background thread and returns a concurrent.futures.Future, so one
+    broadcast worker can keep up to `pool_size` requests in flight.
+    Regular handler calls still go through the shared requests pool.
+    """
+
+    def __init__(self, token, pool_size=100, connect_timeout=5, read_timeout=30, metrics=None):
+        super().__init__(pool_size, connect_timeout, read_timeout)
+        import aiohttp  # нужен только в этом режиме
+
+        self.aiohttp = aiohttp
+        self.token = token
+        self.metrics = metrics
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="bot-api-loop", daemon=True)
+        self.thread.start()
+        self.client = asyncio.run_coroutine_threadsafe(self.open(), self.loop).result()
+
+    async def open(self):
+        # ClientSession должна создаваться внутри работающего цикла
+        return self.aiohttp.ClientSession(
+            connector=self.aiohttp.TCPConnector(limit=self.pool_size),
+            timeout=self.aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout))
+
+    def submit(self, method_name, params):
+        """Call Bot API method `method_name` (e.g. "sendMessage") from any thread."""
+        return asyncio.run_coroutine_threadsafe(self.call(method_name, params), self.loop)
+
+    async def call(self, method_name, params):
+        url = (apihelper.API_URL or DEFAULT_API_URL).format(self.token, method_name)
+        # Форма принимает только строки; None означает "параметр не передан"
+        data = {key: str(value) for key, value in params.items() if value is not None}
+        status = "error"
+        try:
+            async with self.client.post(url, data=data) as response:
+                payload = await response.json(content_type=None)
+            if not payload.get("ok"):
+                status = str(payload.get("error_code"))
+                raise ApiTelegramException(method_name, response, payload)
+            status = "ok"
+            return payload["result"]
+        finally:
+            if self.metrics:
+                self.metrics.inc("api_calls_total", method=snake_case(method_name), status=status)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.client.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        super().close()
+
+
+def snake_case(method_name):
+    """Bot API method name as in metrics.API_METHODS: sendMessage -> send_message."""
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", method_name).lower()
@@ -0,0 +1,66 @@
+import hmac
+import json
+import logging
+
+from telebot import types
+
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookApp:
+    """WSGI endpoint that receives Telegram updates for a BotManager.
+
+    Updates are acknowledged right away and handed to the manager's
+    ChatDispatcher, the same one polling feeds. Only requests carrying
+    `secret_token` are accepted; without one configured every update is
+    refused.
+    """
+
+    def __init__(self, manager, secret_token=None, path="/webhook"):
+        self.manager = manager
+        self.secret_token = secret_token
+        self.path = path
+
+    def __call__(self, environ, start_response):
+        method = environ.get("REQUEST_METHOD")
+        path = environ.get("PATH_INFO", "")
+
+        if method == "GET" and path in ("", "/"):
+            return self.respond(start_response, "200 OK", b"ok")
+        if method == "GET" and path == "/metrics":
+            return self.manager.metrics(environ, start_response)
+        if path != self.path:
+            return self.respond(start_response, "404 Not Found", b"not found")
+        if method != "POST":
+            return self.respond(start_response, "405 Method Not Allowed", b"method not allowed")
+
+        # Telegram передаёт секрет, указанный в setWebhook, в этом заголовке.
+        # Без секрета апдейт с chat id админа мог бы прислать кто угодно
+        received = environ.get("HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN", "")
+        if not self.secret_token or not hmac.compare_digest(received, self.secret_token):
+            return self.respond(start_response, "403 Forbidden", b"forbidden")
+
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            length = 0
+        body = environ["wsgi.input"].read(length) if length > 0 else b""
+        if not body:
+            return self.respond(start_response, "400 Bad Request", b"empty body")
+
+        try:
+            update = types.Update.de_json(json.loads(body))
+        except Exception:
+            logger.exception("Malformed webhook update")
+            return self.respond(start_response, "400 Bad Request", b"bad update")
+
+        if not self.manager.dispatcher.submit(update, block=False):
+            # Очередь чата переполнена - Telegram повторит доставку позже
+            return self.respond(start_response, "503 Service Unavailable", b"busy")
+        return self.respond(start_response, "200 OK", b"ok")
+
+    @staticmethod
+    def respond(start_response, status, body):
+        start_response(status, [("Content-Type", "text/plain"), ("Content-Length", str(len(body)))])
+        return [body]